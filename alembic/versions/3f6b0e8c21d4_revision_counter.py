@@ -0,0 +1,28 @@
+"""Shared revision counter for cache coherence between processes
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-19 13:41:27.902116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '003'
+down_revision = '002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('revision',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("INSERT INTO revision (id, value) VALUES (1, 0)")
+
+
+def downgrade() -> None:
+    op.drop_table('revision')
@@ -0,0 +1,61 @@
+"""Cascade deletes to sorters and parts in the database
+
+Revision ID: 002
+Revises: 001
+Create Date: 2026-10-19 10:12:04.518243
+
+"""
+from alembic import op
+
+
+revision = '002'
+down_revision = '001'
+branch_labels = None
+depends_on = None
+
+# The foreign keys from 001 are unnamed, this gives them names inside batch mode
+naming_convention = {
+    "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
+}
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('sorters', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('fk_sorters_location_locations', type_='foreignkey')
+        batch_op.create_foreign_key(
+            'fk_sorters_location_locations', 'locations', ['location'], ['id'], ondelete='CASCADE'
+        )
+        batch_op.create_index('ix_sorters_location', ['location'])
+
+    with op.batch_alter_table('parts', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('fk_parts_sorter_sorters', type_='foreignkey')
+        batch_op.drop_constraint('fk_parts_location_locations', type_='foreignkey')
+        batch_op.create_foreign_key(
+            'fk_parts_sorter_sorters', 'sorters', ['sorter'], ['id'], ondelete='CASCADE'
+        )
+        batch_op.create_foreign_key(
+            'fk_parts_location_locations', 'locations', ['location'], ['id'], ondelete='CASCADE'
+        )
+        batch_op.create_index('ix_parts_sorter', ['sorter'])
+        batch_op.create_index('ix_parts_location', ['location'])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('parts', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_index('ix_parts_location')
+        batch_op.drop_index('ix_parts_sorter')
+        batch_op.drop_constraint('fk_parts_location_locations', type_='foreignkey')
+        batch_op.drop_constraint('fk_parts_sorter_sorters', type_='foreignkey')
+        batch_op.create_foreign_key(
+            'fk_parts_sorter_sorters', 'sorters', ['sorter'], ['id']
+        )
+        batch_op.create_foreign_key(
+            'fk_parts_location_locations', 'locations', ['location'], ['id']
+        )
+
+    with op.batch_alter_table('sorters', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_index('ix_sorters_location')
+        batch_op.drop_constraint('fk_sorters_location_locations', type_='foreignkey')
+        batch_op.create_foreign_key(
+            'fk_sorters_location_locations', 'locations', ['location'], ['id']
+        )
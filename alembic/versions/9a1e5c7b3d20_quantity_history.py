@@ -0,0 +1,71 @@
+"""Quantity history events and hourly/daily rollups
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-19 15:02:48.377415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '004'
+down_revision = '003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('part_quantity_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('part_id', sa.String(), nullable=False),
+    sa.Column('ts', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('delta', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['part_id'], ['parts.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_part_quantity_events_part_id_ts', 'part_quantity_events', ['part_id', 'ts'])
+    op.create_index('ix_part_quantity_events_ts', 'part_quantity_events', ['ts'])
+    op.create_table('part_quantity_rollups',
+    sa.Column('part_id', sa.String(), nullable=False),
+    sa.Column('bucket', sa.String(), nullable=False),
+    sa.Column('start', sa.Integer(), nullable=False),
+    sa.Column('open_quantity', sa.Integer(), nullable=False),
+    sa.Column('close_quantity', sa.Integer(), nullable=False),
+    sa.Column('min_quantity', sa.Integer(), nullable=False),
+    sa.Column('max_quantity', sa.Integer(), nullable=False),
+    sa.Column('added', sa.Integer(), nullable=False),
+    sa.Column('consumed', sa.Integer(), nullable=False),
+    sa.Column('events', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['part_id'], ['parts.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('part_id', 'bucket', 'start')
+    )
+    op.create_index('ix_part_quantity_rollups_bucket_start', 'part_quantity_rollups', ['bucket', 'start'])
+    op.execute("""
+    CREATE TRIGGER parts_quantity_insert AFTER INSERT ON parts
+    BEGIN
+        INSERT INTO part_quantity_events (part_id, ts, quantity, delta)
+        VALUES (new.id, CAST(strftime('%s', 'now') AS INTEGER), new.quantity, new.quantity);
+    END""")
+    op.execute("""
+    CREATE TRIGGER parts_quantity_update AFTER UPDATE OF quantity ON parts
+    WHEN old.quantity IS NOT new.quantity
+    BEGIN
+        INSERT INTO part_quantity_events (part_id, ts, quantity, delta)
+        VALUES (new.id, CAST(strftime('%s', 'now') AS INTEGER), new.quantity, new.quantity - old.quantity);
+    END""")
+    # Start every existing part's history at its current quantity
+    op.execute("""
+    INSERT INTO part_quantity_events (part_id, ts, quantity, delta)
+    SELECT id, CAST(strftime('%s', 'now') AS INTEGER), quantity, 0 FROM parts""")
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER parts_quantity_update")
+    op.execute("DROP TRIGGER parts_quantity_insert")
+    op.drop_index('ix_part_quantity_rollups_bucket_start', table_name='part_quantity_rollups')
+    op.drop_table('part_quantity_rollups')
+    op.drop_index('ix_part_quantity_events_ts', table_name='part_quantity_events')
+    op.drop_index('ix_part_quantity_events_part_id_ts', table_name='part_quantity_events')
+    op.drop_table('part_quantity_events')
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import yaml
+
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def seed(base_url: str, parts: int):
+    with httpx.Client(base_url=base_url) as client:
+        client.post(
+            "/locations/",
+            json={"id": "bench", "name": "Bench", "icon": "", "tags": "", "attrs": {}},
+        ).raise_for_status()
+        client.post(
+            "/sorters/",
+            json={
+                "id": "bench",
+                "location": "bench",
+                "name": "Bench",
+                "icon": "",
+                "tags": "",
+                "attrs": {},
+            },
+        ).raise_for_status()
+        body = "".join(
+            f'{{"id": "part-{i}", "sorter": "bench", "name": "Part {i}", '
+            f'"quantity": {i}, "location": "bench"}}\n'
+            for i in range(parts)
+        )
+        client.post(
+            "/import", content=body, headers={"content-type": "application/x-ndjson"}
+        ).raise_for_status()
+
+
+async def _hammer(base_url: str, path: str, seconds: float, concurrency: int) -> int:
+    deadline = time.perf_counter() + seconds
+    completed = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal completed
+        while time.perf_counter() < deadline:
+            response = await client.get(path, headers={"Accept-Encoding": "gzip"})
+            response.raise_for_status()
+            completed += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return completed
+
+
+def _load_process(args) -> int:
+    return asyncio.run(_hammer(*args))
+
+
+def measure(base_url: str, path: str, seconds: float, clients: int, concurrency: int) -> float:
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(
+            _load_process, [(base_url, path, seconds, concurrency)] * clients
+        )
+    return sum(results) / seconds
+
+
+def wait_until_up(base_url: str, timeout: float = 30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            httpx.get(f"{base_url}/info/?fetch_github=false").raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise TimeoutError("Server did not start")
+
+
+def start_server(workers: int, port: int, config_path: str) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:create_app", "--factory",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning",
+        ],
+        cwd=CURRENT_DIR,
+        env={**os.environ, "PARTS_INVENTORY_CONFIG": config_path},
+    )
+    wait_until_up(f"http://127.0.0.1:{port}")
+    return server
+
+
+def run(workers: int, args, config_path: str) -> float:
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = start_server(workers, args.port, config_path)
+    try:
+        measure(base_url, args.path, 1, args.clients, args.concurrency)  # warm every worker
+        return measure(base_url, args.path, args.seconds, args.clients, args.concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure read throughput by worker count")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--parts", type=int, default=1000)
+    parser.add_argument("--path", default="/parts/")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--clients", type=int, default=4, help="Load generator processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight per client")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.yaml")
+        with open(config_path, "w", encoding="utf-8") as f:
+            yaml.safe_dump(
+                {
+                    "logging": {"level": 30},
+                    "database": {
+                        "url": f"sqlite:///{os.path.join(directory, 'bench.sqlite')}",
+                        "create_tables": True,
+                    },
+                },
+                f,
+            )
+
+        # Seed through a single worker so the tables are only created once
+        seeder = start_server(1, args.port, config_path)
+        try:
+            seed(f"http://127.0.0.1:{args.port}", args.parts)
+        finally:
+            seeder.terminate()
+            seeder.wait()
+
+        worker_counts = sorted({1, *range(2, args.max_workers + 1, 2), args.max_workers})
+        baseline = None
+        print(f"GET {args.path} with {args.parts} parts")
+        print(f"{'workers':>8} {'req/s':>10} {'speedup':>8}")
+        for workers in worker_counts:
+            throughput = run(workers, args, config_path)
+            baseline = baseline or throughput
+            print(f"{workers:>8} {throughput:>10.0f} {throughput / baseline:>7.2f}x")
@@ -2,13 +2,18 @@ import httpx
 import semver
 
 
-async def fetch_latest_tag(owner: str, repo: str) -> str:
+async def fetch_latest_tag(
+    owner: str, repo: str, client: httpx.AsyncClient | None = None
+) -> str:
     url = f"https://api.github.com/repos/{owner}/{repo}/tags"
 
-    async with httpx.AsyncClient() as client:
+    if client is None:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(url)
+    else:
         response = await client.get(url)
-        response.raise_for_status()
-        tags = response.json()
+    response.raise_for_status()
+    tags = response.json()
 
     valid_tags = []
 
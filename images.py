@@ -0,0 +1,94 @@
+import base64
+import binascii
+import hashlib
+import urllib.parse
+from typing import List, Optional, Tuple
+
+# Part images arrive as strings (normally base64 data URLs) and are stored as
+# their UTF-8 bytes, so they read back as the same string
+
+MAGIC_NUMBERS = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+
+def image_hash(image: bytes) -> bytes:
+    """Hash of a stored image, kept hex encoded so it can be served as text"""
+    return hashlib.sha256(image).hexdigest().encode("ascii")
+
+
+def sniff_format(payload: bytes) -> Optional[str]:
+    """Get the media type of decoded image data from its magic number"""
+    for magic, media_type in MAGIC_NUMBERS:
+        if payload.startswith(magic):
+            return media_type
+    if payload[:4] == b"RIFF" and payload[8:12] == b"WEBP":
+        return "image/webp"
+    head = payload[:256].lstrip()
+    if head.startswith(b"<svg") or (head.startswith(b"<?xml") and b"<svg" in payload[:1024]):
+        return "image/svg+xml"
+    return None
+
+
+def decode(image: bytes) -> Tuple[Optional[str], bytes]:
+    """Get (declared media type, image data) of a stored image
+
+    Accepts data URLs, bare base64 and raw image bytes. Raises ValueError if
+    the image can not be decoded.
+    """
+    if image.startswith(b"data:"):
+        header, separator, data = image[5:].partition(b",")
+        if not separator:
+            raise ValueError("Data URL without a comma")
+        media_type, *parameters = header.decode("ascii", "replace").split(";")
+        if "base64" in parameters:
+            try:
+                return media_type or None, base64.b64decode(data, validate=False)
+            except binascii.Error as e:
+                raise ValueError(f"Invalid base64 in data URL: {e}")
+        return media_type or None, urllib.parse.unquote_to_bytes(data)
+
+    if sniff_format(image):
+        return None, image
+    try:
+        return None, base64.b64decode(image, validate=True)
+    except binascii.Error:
+        raise ValueError("Neither a data URL, base64 nor a known image format")
+
+
+def check(image: bytes, stored_hash: bytes | None, max_bytes: int) -> List[str]:
+    """List what is wrong with a stored image, empty if nothing is"""
+    issues = []
+    if stored_hash is None:
+        issues.append("missing_hash")
+    elif stored_hash != image_hash(image):
+        issues.append("hash_mismatch")
+    try:
+        _, payload = decode(image)
+    except ValueError:
+        return issues + ["undecodable"]
+    if len(payload) > max_bytes:
+        issues.append("oversized")
+    if sniff_format(payload) is None:
+        issues.append("unknown_format")
+    return issues
+
+
+def normalize(image: bytes) -> Optional[bytes]:
+    """Re-encode a stored image as a canonical base64 data URL
+
+    The media type comes from the image data itself. Returns None if the
+    image can not be decoded or its format is not recognized.
+    """
+    try:
+        _, payload = decode(image)
+    except ValueError:
+        return None
+    media_type = sniff_format(payload)
+    if media_type is None:
+        return None
+    return f"data:{media_type};base64,".encode("ascii") + base64.b64encode(payload)
@@ -0,0 +1,245 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from loguru import logger
+from sqlalchemy.exc import SQLAlchemyError
+
+import sorter
+
+FORMATS = ("csv", "ndjson")
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/json-lines": "ndjson",
+}
+DEFAULT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+READ_SIZE = 64 * 1024
+
+
+class ImportRowException(Exception):
+    pass
+
+
+def format_from_content_type(content_type: str | None) -> str | None:
+    if not content_type:
+        return None
+    return CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decode a stream of UTF-8 byte chunks into lines, keeping line endings
+
+    Lines are split before decoding, a newline byte never occurs inside a
+    UTF-8 sequence, so invalid input only fails once its line is reached.
+    """
+    buffer = b""
+    # Only the first line may start with a byte order mark
+    encoding = "utf-8-sig"
+    for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b"\n", start)) != -1:
+            yield buffer[start:end + 1].decode(encoding)
+            encoding = "utf-8"
+            start = end + 1
+        buffer = buffer[start:]
+
+    if buffer:
+        yield buffer.decode(encoding)
+
+
+def iter_records(lines: Iterable[str], fmt: str) -> Iterator[Tuple[int, Dict | Exception]]:
+    """Yield (row number, raw record) pairs, or the parse error for a bad row"""
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for row_number, record in enumerate(reader, start=1):
+            if None in record:
+                yield row_number, ImportRowException("Row has more fields than the header")
+            else:
+                yield row_number, record
+    elif fmt == "ndjson":
+        for row_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield row_number, ImportRowException(f"Invalid JSON: {e}")
+                continue
+            if not isinstance(record, dict):
+                yield row_number, ImportRowException("Row is not a JSON object")
+                continue
+            yield row_number, record
+    else:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def _text(record: Dict, key: str, default: str | None = None) -> str:
+    value = record.get(key)
+    if value is None or value == "":
+        if default is None:
+            raise ImportRowException(f"Missing required field: {key}")
+        return default
+    return str(value)
+
+
+def _boolean(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "y"):
+        return True
+    if text in ("0", "false", "no", "n"):
+        return False
+    raise ImportRowException(f"Invalid boolean: {value}")
+
+
+def normalize_record(record: Dict, sorter_ids: set, location_ids: set) -> Dict:
+    """Turn a raw CSV/NDJSON record into a row for PartSorter.upsert_parts"""
+    uid = _text(record, "id")
+    sorter_id = _text(record, "sorter")
+    location = _text(record, "location")
+    if sorter_id not in sorter_ids:
+        raise ImportRowException(f"Sorter ID: {sorter_id} not found")
+    if location not in location_ids:
+        raise ImportRowException(f"Location ID: {location} not in locations")
+
+    try:
+        quantity = int(_text(record, "quantity", "0"))
+        price = float(_text(record, "price", "0"))
+    except ValueError as e:
+        raise ImportRowException(f"Invalid number: {e}")
+
+    enable_quantity = record.get("enable_quantity")
+    attributes = record.get("attrs") or {}
+    if isinstance(attributes, str):
+        try:
+            attributes = json.loads(attributes)
+        except json.JSONDecodeError as e:
+            raise ImportRowException(f"Invalid attrs JSON: {e}")
+    if not isinstance(attributes, dict):
+        raise ImportRowException("attrs must be a JSON object")
+
+    return {
+        "id": uid,
+        "sorter": sorter_id,
+        "name": _text(record, "name"),
+        "tags": _text(record, "tags", ""),
+        "quantity": quantity,
+        "quantity_type": _text(record, "quantity_type", "pcs"),
+        "enable_quantity": True if enable_quantity in (None, "") else _boolean(enable_quantity),
+        "price": price,
+        "notes": _text(record, "notes", ""),
+        "location": location,
+        "attrs": json.dumps(attributes),
+    }
+
+
+def import_parts(
+    part_sorter: sorter.PartSorter,
+    chunks: Iterable[bytes],
+    fmt: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Dict:
+    """Stream parts from CSV or NDJSON into the database
+
+    Rows are parsed as the chunks arrive and upserted `chunk_size` rows per
+    transaction, so memory use does not depend on the size of the input.
+    Input that is not UTF-8 or not valid CSV stops the import at that point.
+    """
+    started = time.perf_counter()
+    sorter_ids = set(part_sorter.get_sorter_ids())
+    location_ids = set(part_sorter.get_location_ids())
+    report = {"rows": 0, "imported": 0, "failed": 0, "errors": []}
+
+    def fail(row_number: int, uid, error: str):
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            # The id is reported as given, which may not be a string in NDJSON
+            report["errors"].append(
+                {"row": row_number, "id": None if uid is None else str(uid), "error": error}
+            )
+
+    def flush(batch: List[Tuple[int, Dict]]):
+        try:
+            report["imported"] += part_sorter.upsert_parts([row for _, row in batch])
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to import rows {batch[0][0]}-{batch[-1][0]}: {repr(e)}")
+            for row_number, row in batch:
+                fail(row_number, row["id"], "Database error while importing chunk")
+        logger.info(
+            f"Import progress: {report['rows']} rows read, "
+            f"{report['imported']} imported, {report['failed']} failed"
+        )
+
+    batch: List[Tuple[int, Dict]] = []
+    try:
+        for row_number, record in iter_records(iter_lines(chunks), fmt):
+            report["rows"] += 1
+            if isinstance(record, Exception):
+                fail(row_number, None, str(record))
+                continue
+            try:
+                batch.append((row_number, normalize_record(record, sorter_ids, location_ids)))
+            except ImportRowException as e:
+                fail(row_number, record.get("id"), str(e))
+                continue
+
+            if len(batch) >= chunk_size:
+                flush(batch)
+                batch = []
+    except (UnicodeDecodeError, csv.Error) as e:
+        # Nothing after this point can be read, report it as a failed row and
+        # keep the rows before it
+        report["rows"] += 1
+        fail(report["rows"], None, f"Unreadable input, import stopped: {e}")
+
+    if batch:
+        flush(batch)
+
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(
+        f"Imported {report['imported']} of {report['rows']} rows "
+        f"in {report['seconds']} seconds"
+    )
+    return report
+
+
+def read_file(stream) -> Iterator[bytes]:
+    while chunk := stream.read(READ_SIZE):
+        yield chunk
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import parts from CSV or NDJSON")
+    parser.add_argument("file", help="File to import, or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="Input format (default: from file extension)")
+    parser.add_argument("--database-url", default="sqlite:///partsdb.sqlite")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "csv" if args.file.lower().endswith(".csv") else "ndjson"
+
+    if args.file == "-":
+        result = import_parts(
+            sorter.PartSorter(args.database_url), read_file(sys.stdin.buffer), fmt, args.chunk_size
+        )
+    else:
+        with open(args.file, "rb") as f:
+            result = import_parts(
+                sorter.PartSorter(args.database_url), read_file(f), fmt, args.chunk_size
+            )
+
+    for error in result["errors"]:
+        logger.warning(f"Row {error['row']} ({error['id']}): {error['error']}")
+    sys.exit(1 if result["failed"] else 0)
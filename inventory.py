@@ -0,0 +1,190 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+from loguru import logger
+
+import jobs
+import snapshot
+import sorter
+import suggest
+
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+PATH_PATTERN = re.compile(r"^/inventories/(?P<name>[^/]+)(?=/|$)")
+
+
+class InventoryNameInvalidException(Exception):
+    pass
+
+
+class Inventory:
+    """One inventory's database and the caches built on top of it"""
+
+    def __init__(
+        self,
+        name: str,
+        part_sorter: sorter.PartSorter,
+        snapshots: snapshot.SnapshotCache,
+        suggest_index: suggest.PrefixIndex,
+        job_manager: jobs.JobManager,
+    ):
+        self.name = name
+        self.part_sorter = part_sorter
+        self.snapshots = snapshots
+        self.suggest_index = suggest_index
+        self.job_manager = job_manager
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        # Jobs do not keep an inventory open, closing it cancels them
+        self.job_manager.close()
+        self.part_sorter.close()
+
+
+class InventoryRegistry:
+    """LRU of open inventories, each backed by its own database
+
+    `open_inventory(name)` builds an Inventory, migrating its database first,
+    and runs at most once per name until that inventory is closed again.
+    Inventories are closed once more than `max_open` are open or after
+    `idle_timeout` seconds without requests, but never while in use.
+    """
+
+    def __init__(
+        self,
+        open_inventory: Callable[[str], Inventory],
+        max_open: int = 8,
+        idle_timeout: float = 600,
+    ):
+        self.open_inventory = open_inventory
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._inventories: OrderedDict[str, Inventory] = OrderedDict()
+        # Opening runs migrations, so it happens outside of the registry lock.
+        # Entries only exist while requests for that name are being acquired.
+        self._opening: Dict[str, threading.Lock] = {}
+        self._waiting: Dict[str, int] = {}
+
+    @contextmanager
+    def use(self, name: str) -> Iterator[Inventory]:
+        """Open the inventory called `name` if needed and keep it open inside the block"""
+        inventory = self._acquire(name)
+        try:
+            yield inventory
+        finally:
+            self._release([inventory], touch=True)
+
+    @contextmanager
+    def use_open(self) -> Iterator[List[Inventory]]:
+        """Keep every currently open inventory open inside the block, without
+        counting it as used for idle eviction (e.g. for background jobs)"""
+        with self._lock:
+            inventories = list(self._inventories.values())
+            for inventory in inventories:
+                inventory.users += 1
+        try:
+            yield inventories
+        finally:
+            self._release(inventories, touch=False)
+
+    def _acquire(self, name: str) -> Inventory:
+        if not NAME_PATTERN.match(name):
+            raise InventoryNameInvalidException(f"Invalid inventory name: {name}")
+
+        with self._lock:
+            opening = self._opening.setdefault(name, threading.Lock())
+            self._waiting[name] = self._waiting.get(name, 0) + 1
+        try:
+            with opening:
+                with self._lock:
+                    inventory = self._inventories.get(name)
+                    if inventory is not None:
+                        self._inventories.move_to_end(name)
+                        inventory.users += 1
+                        return inventory
+
+                inventory = self.open_inventory(name)
+                logger.info(f"Opened inventory {name}")
+                with self._lock:
+                    inventory.users += 1
+                    self._inventories[name] = inventory
+                    evicted = self._take_evictable(time.monotonic())
+        finally:
+            with self._lock:
+                self._waiting[name] -= 1
+                if not self._waiting[name]:
+                    del self._waiting[name]
+                    del self._opening[name]
+        self._close(evicted)
+        return inventory
+
+    def _release(self, inventories: List[Inventory], touch: bool):
+        now = time.monotonic()
+        with self._lock:
+            for inventory in inventories:
+                inventory.users -= 1
+                if touch:
+                    inventory.last_used = now
+            evicted = self._take_evictable(now)
+        self._close(evicted)
+
+    def _take_evictable(self, now: float) -> List[Inventory]:
+        evicted = []
+        # Least recently used first
+        for name, inventory in list(self._inventories.items()):
+            if inventory.users:
+                continue
+            if len(self._inventories) > self.max_open or now - inventory.last_used > self.idle_timeout:
+                evicted.append(self._inventories.pop(name))
+        return evicted
+
+    @staticmethod
+    def _close(inventories: List[Inventory]):
+        for inventory in inventories:
+            try:
+                inventory.close()
+                logger.info(f"Closed inventory {inventory.name}")
+            except Exception as e:
+                logger.error(f"Failed to close inventory {inventory.name}: {repr(e)}")
+
+    def evict_idle(self):
+        with self._lock:
+            evicted = self._take_evictable(time.monotonic())
+        self._close(evicted)
+
+    def close(self):
+        with self._lock:
+            inventories = list(self._inventories.values())
+            self._inventories.clear()
+        self._close(inventories)
+
+
+class InventoryPathMiddleware:
+    """Route /inventories/{name}/... to the regular endpoints
+
+    The prefix becomes part of the root path, the same way a mounted app
+    sees it, and the name is left in scope["inventory"] for get_inventory.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            root_path = scope.get("root_path", "")
+            path = scope["path"]
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path):]
+            match = PATH_PATTERN.match(path)
+            if match:
+                scope = {
+                    **scope,
+                    "inventory": match["name"],
+                    "root_path": root_path + match[0],
+                }
+        await self.app(scope, receive, send)
@@ -0,0 +1,295 @@
+import json
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import psutil
+from loguru import logger
+from sqlalchemy import update
+from sqlalchemy.sql import func
+
+import images
+import sorter
+from models import Job
+
+# How many offending parts a scan lists, like the importer's error list
+MAX_REPORTED = 1000
+
+
+class JobInvalidException(Exception):
+    pass
+
+
+class JobQueueFullException(Exception):
+    pass
+
+
+class JobCancelledException(Exception):
+    pass
+
+
+def _start_time(pid: int) -> str:
+    """When a process started, as a unix time rounded for comparison"""
+    return f"{psutil.Process(pid).create_time():.2f}"
+
+
+def process_owner() -> str:
+    """Identify this process as host:boot time:pid:start time"""
+    pid = os.getpid()
+    return f"{socket.gethostname()}:{int(psutil.boot_time())}:{pid}:{_start_time(pid)}"
+
+
+def owner_exited(owner: str | None) -> bool:
+    """Whether the process identified by `owner` has certainly exited
+
+    Processes on other hosts (or in other containers) can not be checked and
+    are assumed to be alive. The start time tells a reused pid apart.
+    """
+    if not owner:
+        return True
+    host, boot_time, pid, start_time = owner.split(":")
+    if host != socket.gethostname():
+        return False
+    # Boot time is derived from the uptime on some platforms and may drift a little
+    if abs(int(boot_time) - psutil.boot_time()) > 2:
+        return True
+    try:
+        return _start_time(int(pid)) != start_time
+    except psutil.NoSuchProcess:
+        return True
+    except psutil.AccessDenied:
+        return False
+
+
+class JobProgress:
+    """Handed to running jobs to report progress and notice cancellation"""
+
+    def __init__(self, manager: "JobManager", job_id: str):
+        self.manager = manager
+        self.job_id = job_id
+        self.processed = 0
+
+    def batches(self, batches: Iterable[List], total: int | None = None) -> Iterator[List]:
+        """Yield batches, saving progress after each and stopping on shutdown"""
+        self.manager._update(self.job_id, total=total)
+        for batch in batches:
+            if self.manager.stopping.is_set():
+                raise JobCancelledException()
+            yield batch
+            self.processed += len(batch)
+            self.manager._update(self.job_id, processed=self.processed)
+
+
+def rehash_images(part_sorter: sorter.PartSorter, params: dict, progress: JobProgress) -> dict:
+    """Recompute image_hash where it is missing or does not match the image
+
+    Parts whose image was changed or that were deleted while the job ran are
+    counted as skipped.
+    """
+    updated = skipped = 0
+    for batch in progress.batches(
+        part_sorter.iter_part_images(params["batch_size"]), part_sorter.count_part_images()
+    ):
+        rows = []
+        for part in batch:
+            digest = images.image_hash(part.image)
+            if digest != part.image_hash:
+                rows.append({"id": part.id, "old_image": part.image, "image_hash": digest})
+        written = part_sorter.update_part_images(rows)
+        updated += written
+        skipped += len(rows) - written
+    return {"updated": updated, "skipped": skipped}
+
+
+def scan_images(part_sorter: sorter.PartSorter, params: dict, progress: JobProgress) -> dict:
+    """Report images that are undecodable, of an unknown format, oversized or mis-hashed"""
+    counts: Dict[str, int] = {}
+    parts = []
+    for batch in progress.batches(
+        part_sorter.iter_part_images(params["batch_size"]), part_sorter.count_part_images()
+    ):
+        for part in batch:
+            issues = images.check(part.image, part.image_hash, params["max_image_bytes"])
+            for issue in issues:
+                counts[issue] = counts.get(issue, 0) + 1
+            if issues and len(parts) < MAX_REPORTED:
+                parts.append({"id": part.id, "issues": issues, "bytes": len(part.image)})
+    return {"issues": counts, "parts": parts}
+
+
+def normalize_images(part_sorter: sorter.PartSorter, params: dict, progress: JobProgress) -> dict:
+    """Re-encode images as canonical base64 data URLs typed by their content
+
+    Images that can not be decoded are left alone, run image_scan to find them.
+    They are counted as skipped, like parts whose image was changed or that
+    were deleted while the job ran.
+    """
+    rewritten = skipped = 0
+    for batch in progress.batches(
+        part_sorter.iter_part_images(params["batch_size"]), part_sorter.count_part_images()
+    ):
+        rows = []
+        for part in batch:
+            image = images.normalize(part.image)
+            if image is None:
+                skipped += 1
+                continue
+            digest = images.image_hash(image)
+            if image != part.image or digest != part.image_hash:
+                rows.append(
+                    {"id": part.id, "old_image": part.image, "image": image, "image_hash": digest}
+                )
+        written = part_sorter.update_part_images(rows)
+        rewritten += written
+        skipped += len(rows) - written
+    return {"rewritten": rewritten, "skipped": skipped}
+
+
+JOB_KINDS: Dict[str, Callable[[sorter.PartSorter, dict, JobProgress], dict]] = {
+    "image_rehash": rehash_images,
+    "image_scan": scan_images,
+    "image_normalize": normalize_images,
+}
+
+
+class JobManager:
+    """Run maintenance jobs for one database in a shared, bounded thread pool
+
+    Jobs are stored in the `jobs` table, so their progress can be read by any
+    worker. They read parts in batches through short transactions and write
+    through PartSorter, so requests are never blocked for long. Closing the
+    manager cancels queued jobs and stops running ones after their current batch.
+
+    Each job records the process that owns it. Jobs left queued or running by
+    a process that exited without closing its manager (a crash, a kill) are
+    marked as failed when a manager is created for the database.
+    """
+
+    def __init__(
+        self,
+        part_sorter: sorter.PartSorter,
+        executor: Executor,
+        max_queued: int = 16,
+        defaults: dict | None = None,
+    ):
+        self.part_sorter = part_sorter
+        self.executor = executor
+        self.max_queued = max_queued
+        self.defaults = {"batch_size": 200, "max_image_bytes": 2 * 1024 * 1024, **(defaults or {})}
+        self.stopping = threading.Event()
+        self.owner = process_owner()
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}
+        self._fail_orphaned()
+
+    def _fail_orphaned(self):
+        unfinished = ("queued", "running")
+        with self.part_sorter.get_session() as session:
+            jobs = session.query(Job.id, Job.owner).filter(Job.status.in_(unfinished)).all()
+            orphaned = [job.id for job in jobs if owner_exited(job.owner)]
+            if not orphaned:
+                return
+            session.execute(
+                update(Job)
+                .where(Job.id.in_(orphaned), Job.status.in_(unfinished))
+                .values(
+                    status="failed",
+                    error="Interrupted, the process running the job exited",
+                    finished_at=func.current_timestamp(),
+                )
+            )
+            session.commit()
+        logger.warning(f"Marked {len(orphaned)} jobs of exited processes as failed: {orphaned}")
+
+    def submit(self, kind: str, params: dict | None = None) -> dict:
+        if kind not in JOB_KINDS:
+            raise JobInvalidException(
+                f"Unknown job kind: {kind}, use one of: {', '.join(JOB_KINDS)}"
+            )
+        params = {**self.defaults, **{k: v for k, v in (params or {}).items() if v is not None}}
+
+        with self._lock:
+            self._futures = {uid: f for uid, f in self._futures.items() if not f.done()}
+            if len(self._futures) >= self.max_queued:
+                raise JobQueueFullException("Too many jobs are queued, try again later")
+
+            job_id = uuid.uuid4().hex
+            with self.part_sorter.get_session() as session:
+                session.add(
+                    Job(
+                        id=job_id,
+                        kind=kind,
+                        status="queued",
+                        params=json.dumps(params),
+                        processed=0,
+                        owner=self.owner,
+                    )
+                )
+                session.commit()
+            self._futures[job_id] = self.executor.submit(self._run, job_id, kind, params)
+        logger.info(f"Queued {kind} job {job_id}")
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.part_sorter.get_session() as session:
+            job = session.get(Job, job_id)
+            if job is None:
+                return None
+            return {
+                "id": job.id,
+                "kind": job.kind,
+                "status": job.status,
+                "params": json.loads(job.params),
+                "processed": job.processed,
+                "total": job.total,
+                "result": json.loads(job.result) if job.result else None,
+                "error": job.error,
+                "created_at": job.created_at,
+                "started_at": job.started_at,
+                "finished_at": job.finished_at,
+            }
+
+    def _update(self, job_id: str, **values):
+        with self.part_sorter.get_session() as session:
+            session.execute(update(Job).where(Job.id == job_id).values(**values))
+            session.commit()
+
+    def _run(self, job_id: str, kind: str, params: dict):
+        if self.stopping.is_set():
+            self._update(job_id, status="cancelled", finished_at=func.current_timestamp())
+            return
+
+        self._update(job_id, status="running", started_at=func.current_timestamp())
+        try:
+            result = JOB_KINDS[kind](self.part_sorter, params, JobProgress(self, job_id))
+        except JobCancelledException:
+            logger.warning(f"Cancelled {kind} job {job_id}")
+            self._update(job_id, status="cancelled", finished_at=func.current_timestamp())
+        except Exception as e:
+            logger.error(f"{kind} job {job_id} failed: {repr(e)}")
+            self._update(
+                job_id, status="failed", error=repr(e), finished_at=func.current_timestamp()
+            )
+        else:
+            logger.info(f"Finished {kind} job {job_id}: {result}")
+            self._update(
+                job_id,
+                status="succeeded",
+                result=json.dumps(result),
+                finished_at=func.current_timestamp(),
+            )
+
+    def close(self):
+        """Cancel queued jobs and wait for running ones to stop"""
+        self.stopping.set()
+        with self._lock:
+            futures = list(self._futures.items())
+        for job_id, future in futures:
+            if future.cancel():
+                self._update(job_id, status="cancelled", finished_at=func.current_timestamp())
+        for _, future in futures:
+            if not future.cancelled():
+                future.exception()
@@ -1,63 +1,130 @@
+import time
+
+_import_started = time.perf_counter()
+
+import asyncio
 import sys
 import os
 import traceback
 import urllib.parse
-from typing import List, Optional
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Callable, Iterator, List, Literal, Optional
 
-import httpx
+import anyio.from_thread
 import yaml
-from fastapi import FastAPI, HTTPException
+from fastapi import (
+    APIRouter,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
-from pydantic import BaseModel
-import psutil
+from pydantic import BaseModel, Field, TypeAdapter
 
 import sorter  # Make sure to import your database module here
-import fetch_version
+import snapshot
+import importer
+import inventory
+import jobs
+import suggest
+
+# httpx, psutil and fetch_version (semver) are imported where they are used,
+# they are only needed for a few rarely called endpoints
 
 __version__ = "0.1.0"
 __repo__ = ["meowmeowahr", "PartsInventoryBackend"]
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_DATABASE_URL = "sqlite:///partsdb.sqlite"
 
-# Import yaml config
-with open(os.path.join(CURRENT_DIR, "config.yaml"), encoding="utf-8") as stream:
+
+def load_config(path: str | None = None) -> dict:
+    """Load the configuration from `path`, $PARTS_INVENTORY_CONFIG or config.yaml"""
+    if path is None:
+        path = os.environ.get(
+            "PARTS_INVENTORY_CONFIG", os.path.join(CURRENT_DIR, "config.yaml")
+        )
+    with open(path, encoding="utf-8") as stream:
+        try:
+            configuration: dict = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            traceback.print_exc()
+            logger.critical("YAML Parsing Error, %s", exc)
+            sys.exit(0)
+
+    if not configuration:
+        configuration: dict = {}
+    return configuration
+
+
+def configure_logging(configuration: dict):
+    logging_config: dict = configuration.get("logging", {})
+    logging_level: int = logging_config.get("level", 20)
+    logger.remove()
+    logger.add(sys.stdout, level=logging_level)
+
+
+router = APIRouter()
+
+
+def get_inventory(request: Request) -> Iterator[inventory.Inventory]:
+    """The inventory a request works on
+
+    With `inventories.enabled` it is picked by a /inventories/{name}/ path
+    prefix or the X-Inventory header, and kept open until the response is sent.
+    """
+    registry: inventory.InventoryRegistry | None = request.app.state.inventories
+    if registry is None:
+        yield request.app.state.inventory
+        return
+
+    name = (
+        request.scope.get("inventory")
+        or request.headers.get("x-inventory")
+        or request.app.state.default_inventory
+    )
+    if not name:
+        raise HTTPException(
+            status_code=400,
+            detail="Choose an inventory with /inventories/{name}/ or the X-Inventory header",
+        )
     try:
-        configuration: dict = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        traceback.print_exc()
-        logger.critical("YAML Parsing Error, %s", exc)
-        sys.exit(0)
-
-if not configuration:
-    configuration: dict = {}
-
-# logging config
-logging_config: dict = configuration.get("logging", {})
-logging_level: int = logging_config.get("level", 20)
-logger.remove()
-logger.add(sys.stdout, level=logging_level)
-
-# server config
-server_config: dict = configuration.get("server", {})
-server_port: int = int(server_config.get("ip", 8000))
-server_host: str = str(server_config.get("host", "0.0.0.0"))
-
-app = FastAPI()
-
-origins = [
-    "*",
-]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+        with registry.use(name) as selected:
+            yield selected
+    except inventory.InventoryNameInvalidException as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def get_part_sorter(
+    selected: inventory.Inventory = Depends(get_inventory),
+) -> sorter.PartSorter:
+    return selected.part_sorter
+
+
+def get_snapshots(
+    selected: inventory.Inventory = Depends(get_inventory),
+) -> snapshot.SnapshotCache:
+    return selected.snapshots
+
 
-part_sorter = sorter.PartSorter()
+def get_suggest_index(
+    selected: inventory.Inventory = Depends(get_inventory),
+) -> suggest.PrefixIndex:
+    return selected.suggest_index
+
+
+def get_job_manager(
+    selected: inventory.Inventory = Depends(get_inventory),
+) -> jobs.JobManager:
+    return selected.job_manager
 
 
 class Location(BaseModel):
@@ -115,6 +182,89 @@ class PartIdentify(BaseModel):
     api: str
 
 
+class ImportRowError(BaseModel):
+    row: int
+    id: str | None
+    error: str
+
+
+class ImportResult(BaseModel):
+    rows: int
+    imported: int
+    failed: int
+    errors: List[ImportRowError]
+    seconds: float
+
+
+class PartSuggestion(BaseModel):
+    id: str
+    name: str
+    tags: str
+    score: float
+
+
+class QuantityHistoryPoint(BaseModel):
+    start: datetime
+    open_quantity: int
+    close_quantity: int
+    min_quantity: int
+    max_quantity: int
+    added: int
+    consumed: int
+    events: int
+
+
+class JobRequest(BaseModel):
+    batch_size: int | None = Field(None, gt=0, le=10000)
+    max_image_bytes: int | None = Field(None, gt=0)
+
+
+class JobStatus(BaseModel):
+    id: str
+    kind: str
+    status: str
+    params: dict
+    processed: int
+    total: int | None
+    result: dict | None
+    error: str | None
+    created_at: datetime | None
+    started_at: datetime | None
+    finished_at: datetime | None
+
+
+class SorterTree(Sorter):
+    parts: List[Part]
+
+
+class LocationTree(Location):
+    sorters: List[SorterTree]
+
+
+def create_snapshots(part_sorter: sorter.PartSorter) -> snapshot.SnapshotCache:
+    snapshots = snapshot.SnapshotCache(part_sorter.get_read_revision)
+    snapshots.register("locations", part_sorter.get_locations, TypeAdapter(List[Location]))
+    snapshots.register("sorters", part_sorter.get_sorters, TypeAdapter(List[Sorter]))
+    # Part does not include images, so the snapshot does not load them
+    snapshots.register(
+        "parts", lambda: part_sorter.get_parts(include_images=False), TypeAdapter(List[Part])
+    )
+    return snapshots
+
+
+def snapshot_response(
+    snapshots: snapshot.SnapshotCache, name: str, accept_encoding: str | None
+) -> Response:
+    snap = snapshots.get(name)
+    encoding = snapshot.choose_encoding(accept_encoding, snapshots.encodings)
+    headers = {"ETag": snap.etag, "Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=snap.payloads[encoding], media_type="application/json", headers=headers
+    )
+
+
 class SystemInfo(BaseModel):
     version: str
     latest_version: Optional[str]
@@ -123,10 +273,16 @@ class SystemInfo(BaseModel):
     memory_usage: float
 
 
-@app.get("/info/", response_model=SystemInfo)
-async def get_info(fetch_github: bool = True):
+@router.get("/info/", response_model=SystemInfo)
+async def get_info(request: Request, fetch_github: bool = True):
+    import psutil
+
     if fetch_github:
-        latest_version = await fetch_version.fetch_latest_tag(*__repo__)
+        import fetch_version
+
+        latest_version = await fetch_version.fetch_latest_tag(
+            *__repo__, client=request.app.state.http_client
+        )
     else:
         latest_version = "Unknown"
 
@@ -139,8 +295,11 @@ async def get_info(fetch_github: bool = True):
     }
 
 
-@app.post("/locations/", response_model=Location, status_code=201)
-def create_location(location: Location):
+@router.post("/locations/", response_model=Location, status_code=201)
+def create_location(
+    location: Location,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
         part_sorter.create_location(
             location.id, location.name, location.icon, location.tags, location.attrs
@@ -150,13 +309,19 @@ def create_location(location: Location):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.get("/locations/", response_model=List[Location])
-def get_locations():
-    return part_sorter.get_locations()
+@router.get("/locations/", response_model=List[Location])
+def get_locations(
+    accept_encoding: str | None = Header(None),
+    snapshots: snapshot.SnapshotCache = Depends(get_snapshots),
+):
+    return snapshot_response(snapshots, "locations", accept_encoding)
 
 
-@app.get("/locations/{location_id}", response_model=Location)
-def get_location(location_id: str):
+@router.get("/locations/{location_id}", response_model=Location)
+def get_location(
+    location_id: str,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     locations = part_sorter.get_locations()
     for loc in locations:
         if loc["id"] == location_id:
@@ -164,8 +329,28 @@ def get_location(location_id: str):
     raise HTTPException(status_code=404, detail="Location not found")
 
 
-@app.put("/locations/{location_id}", response_model=Location)
-def update_location(location_id: str, location: Location):
+@router.get("/locations/{location_id}/tree", response_model=LocationTree)
+def get_location_tree(
+    location_id: str,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
+    tree = part_sorter.get_location_tree(location_id)
+    if not tree:
+        raise HTTPException(status_code=404, detail="Location not found")
+    return tree[0]
+
+
+@router.get("/tree", response_model=List[LocationTree])
+def get_tree(part_sorter: sorter.PartSorter = Depends(get_part_sorter)):
+    return part_sorter.get_location_tree()
+
+
+@router.put("/locations/{location_id}", response_model=Location)
+def update_location(
+    location_id: str,
+    location: Location,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
         part_sorter.update_location(
             location_id, location.name, location.icon, location.tags, location.attrs
@@ -175,17 +360,36 @@ def update_location(location_id: str, location: Location):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.delete("/locations/{location_id}")
-def delete_location(location_id: str):
+@router.put("/locations/{location_id}/upsert", response_model=Location)
+def upsert_location(
+    location_id: str,
+    location: Location,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
+    location = location.model_copy(update={"id": location_id})
+    part_sorter.upsert_location(
+        location.id, location.name, location.icon, location.tags, location.attrs
+    )
+    return location
+
+
+@router.delete("/locations/{location_id}")
+def delete_location(
+    location_id: str,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
-        part_sorter.delete_location(location_id)
-        return {"detail": "Location deleted successfully"}
+        deleted = part_sorter.delete_location(location_id)
+        return {"detail": "Location deleted successfully", "deleted": deleted}
     except sorter.SorterIdInvalidException as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post("/sorters/", response_model=Sorter, status_code=201)
-def create_sorter(sorter_item: Sorter):
+@router.post("/sorters/", response_model=Sorter, status_code=201)
+def create_sorter(
+    sorter_item: Sorter,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
         part_sorter.create_sorter(
             sorter_item.id,
@@ -200,13 +404,19 @@ def create_sorter(sorter_item: Sorter):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.get("/sorters/", response_model=List[Sorter])
-def get_sorters():
-    return part_sorter.get_sorters()
+@router.get("/sorters/", response_model=List[Sorter])
+def get_sorters(
+    accept_encoding: str | None = Header(None),
+    snapshots: snapshot.SnapshotCache = Depends(get_snapshots),
+):
+    return snapshot_response(snapshots, "sorters", accept_encoding)
 
 
-@app.get("/sorters/{sorter_id}", response_model=Sorter)
-def get_sorter(sorter_id: str):
+@router.get("/sorters/{sorter_id}", response_model=Sorter)
+def get_sorter(
+    sorter_id: str,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     sorters = part_sorter.get_sorters()
     for sort in sorters:
         if sort["id"] == sorter_id:
@@ -214,8 +424,12 @@ def get_sorter(sorter_id: str):
     raise HTTPException(status_code=404, detail="Sorter not found")
 
 
-@app.put("/sorters/{sorter_id}", response_model=Sorter)
-def update_sorter(sorter_id: str, sorter_item: Sorter):
+@router.put("/sorters/{sorter_id}", response_model=Sorter)
+def update_sorter(
+    sorter_id: str,
+    sorter_item: Sorter,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
         part_sorter.update_sorter(
             sorter_id,
@@ -230,17 +444,44 @@ def update_sorter(sorter_id: str, sorter_item: Sorter):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.delete("/sorters/{sorter_id}")
-def delete_sorter(sorter_id: str):
+@router.put("/sorters/{sorter_id}/upsert", response_model=Sorter)
+def upsert_sorter(
+    sorter_id: str,
+    sorter_item: Sorter,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
+    sorter_item = sorter_item.model_copy(update={"id": sorter_id})
+    try:
+        part_sorter.upsert_sorter(
+            sorter_item.id,
+            sorter_item.location,
+            sorter_item.name,
+            sorter_item.icon,
+            sorter_item.tags,
+            sorter_item.attrs,
+        )
+        return sorter_item
+    except sorter.SorterIdInvalidException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.delete("/sorters/{sorter_id}")
+def delete_sorter(
+    sorter_id: str,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
-        part_sorter.delete_sorter(sorter_id)
-        return {"detail": "Sorter deleted successfully"}
+        deleted = part_sorter.delete_sorter(sorter_id)
+        return {"detail": "Sorter deleted successfully", "deleted": deleted}
     except sorter.SorterIdInvalidException as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post("/parts_individual/", response_model=Part, status_code=201)
-def create_part(part_item: Part):
+@router.post("/parts_individual/", response_model=Part, status_code=201)
+def create_part(
+    part_item: Part,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
         part_sorter.create_part(
             part_item.id,
@@ -260,19 +501,32 @@ def create_part(part_item: Part):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.get("/parts/", response_model=List[Part])
-def get_parts():
-    parts = part_sorter.get_parts()
-    parts_without_images = []
-    for part in parts:
-        part.pop("image")
-        parts_without_images.append(part)
-
-    return parts_without_images
-
-
-@app.get("/parts/{sorter_id}", response_model=List[Part])
-def get_parts_from_sorter(sorter_id: str):
+@router.get("/parts/", response_model=List[Part])
+def get_parts(
+    accept_encoding: str | None = Header(None),
+    snapshots: snapshot.SnapshotCache = Depends(get_snapshots),
+):
+    return snapshot_response(snapshots, "parts", accept_encoding)
+
+
+@router.get("/parts/suggest", response_model=List[PartSuggestion])
+def suggest_parts(
+    prefix: str,
+    limit: int = Query(10, gt=0, le=100),
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+    suggest_index: suggest.PrefixIndex = Depends(get_suggest_index),
+):
+    suggest_index.ensure_current(
+        part_sorter.get_revision(), part_sorter.get_part_search_terms
+    )
+    return suggest_index.search(prefix, limit)
+
+
+@router.get("/parts/{sorter_id}", response_model=List[Part])
+def get_parts_from_sorter(
+    sorter_id: str,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     parts: list[dict] = part_sorter.get_parts()
     parts_in_sorter = []
 
@@ -283,8 +537,12 @@ def get_parts_from_sorter(sorter_id: str):
     return parts_in_sorter
 
 
-@app.put("/parts_individual/{part_id}", response_model=PartNullable)
-def update_part(part_id: str, part_item: PartNullable):
+@router.put("/parts_individual/{part_id}", response_model=PartNullable)
+def update_part(
+    part_id: str,
+    part_item: PartNullable,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
         part_sorter.update_part(
             part_id,
@@ -304,8 +562,38 @@ def update_part(part_id: str, part_item: PartNullable):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.put("/parts_individual/{part_id}/image", response_model=PartImageNullable)
-def set_part_image(part_id: str, part_item: PartImageNullable):
+@router.put("/parts_individual/{part_id}/upsert", response_model=Part)
+def upsert_part(
+    part_id: str,
+    part_item: Part,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
+    part_item = part_item.model_copy(update={"id": part_id})
+    try:
+        part_sorter.upsert_part(
+            part_item.id,
+            part_item.sorter,
+            part_item.name,
+            part_item.quantity,
+            part_item.quantity_type,
+            part_item.enable_quantity,
+            part_item.tags,
+            part_item.price,
+            part_item.notes,
+            part_item.location,
+            part_item.attrs,
+        )
+        return part_item
+    except sorter.SorterIdInvalidException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.put("/parts_individual/{part_id}/image", response_model=PartImageNullable)
+def set_part_image(
+    part_id: str,
+    part_item: PartImageNullable,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
         part_sorter.set_part_image(part_id, part_item.image)
         return part_item
@@ -313,8 +601,8 @@ def set_part_image(part_id: str, part_item: PartImageNullable):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.get("/parts_individual/{part_id}")
-def get_part(part_id: str):
+@router.get("/parts_individual/{part_id}")
+def get_part(part_id: str, part_sorter: sorter.PartSorter = Depends(get_part_sorter)):
     parts = part_sorter.get_parts()
     for part in parts:
         if part["id"] == part_id:
@@ -322,34 +610,348 @@ def get_part(part_id: str):
     raise HTTPException(status_code=404, detail="Part not found")
 
 
-@app.delete("/parts_individual/{part_id}")
-def delete_part(part_id: str):
+@router.get(
+    "/parts_individual/{part_id}/history", response_model=List[QuantityHistoryPoint]
+)
+def get_part_history(
+    part_id: str,
+    bucket: Literal["raw", "hour", "day"] = "day",
+    start: datetime | None = None,
+    end: datetime | None = None,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
+    """Quantity over time in 'hour' or 'day' buckets, or 'raw' for single changes
+
+    Buckets are filled in by the background rollup, so the newest one may lag
+    behind by up to `history.rollup_interval_s`.
+    """
+
+    def timestamp(moment: datetime | None) -> int | None:
+        if moment is None:
+            return None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return int(moment.timestamp())
+
+    try:
+        history = part_sorter.get_quantity_history(
+            part_id, bucket, timestamp(start), timestamp(end)
+        )
+    except sorter.SorterIdInvalidException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for point in history:
+        point["start"] = datetime.fromtimestamp(point["start"], timezone.utc)
+    return history
+
+
+@router.delete("/parts_individual/{part_id}")
+def delete_part(
+    part_id: str,
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
     try:
-        part_sorter.delete_part(part_id)
-        return {"detail": "Sorter deleted successfully"}
+        deleted = part_sorter.delete_part(part_id)
+        return {"detail": "Sorter deleted successfully", "deleted": deleted}
     except sorter.SorterIdInvalidException as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post("/part_identify/")
-async def identify_part(response: PartIdentify):
-    async with httpx.AsyncClient() as client:
+@router.post("/import", response_model=ImportResult)
+async def import_parts(
+    request: Request,
+    fmt: str | None = Query(None, alias="format"),
+    chunk_size: int = Query(importer.DEFAULT_CHUNK_SIZE, gt=0),
+    part_sorter: sorter.PartSorter = Depends(get_part_sorter),
+):
+    fmt = fmt or importer.format_from_content_type(request.headers.get("content-type"))
+    if fmt not in importer.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported import format, use one of: {', '.join(importer.FORMATS)}",
+        )
+
+    body = request.stream()
+
+    def chunks():
+        # Pull the request body from the event loop as the importer needs it
+        while True:
+            try:
+                yield anyio.from_thread.run(body.__anext__)
+            except StopAsyncIteration:
+                return
+
+    return await run_in_threadpool(
+        importer.import_parts, part_sorter, chunks(), fmt, chunk_size
+    )
+
+
+@router.post("/part_identify/")
+async def identify_part(request: Request, response: PartIdentify):
+    import httpx
+
+    client: httpx.AsyncClient = request.app.state.http_client
+    try:
+        res = await client.post(
+            urllib.parse.urljoin(response.api, "/identify"),
+            json={"location": response.location},
+        )
+        res.raise_for_status()  # Raise an exception for 4xx/5xx responses
+        return res.json()
+    except httpx.HTTPStatusError as exc:
+        raise HTTPException(
+            status_code=exc.response.status_code, detail=exc.response.text
+        )
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
+@router.post("/jobs/{kind}", response_model=JobStatus, status_code=202)
+def create_job(
+    kind: str,
+    job_request: JobRequest | None = None,
+    job_manager: jobs.JobManager = Depends(get_job_manager),
+):
+    """Start a background job: image_rehash, image_scan or image_normalize"""
+    try:
+        return job_manager.submit(kind, job_request.model_dump() if job_request else None)
+    except jobs.JobInvalidException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except jobs.JobQueueFullException as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+
+@router.get("/jobs/{job_id}", response_model=JobStatus)
+def get_job(job_id: str, job_manager: jobs.JobManager = Depends(get_job_manager)):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def warmup(part_sorter: sorter.PartSorter, snapshots: snapshot.SnapshotCache):
+    """Open database connections and build the collection snapshots ahead of traffic"""
+    part_sorter.warmup()
+    for name in ("locations", "sorters", "parts"):
+        snapshots.get(name)
+
+
+def open_inventory(
+    name: str,
+    database_url: str,
+    configuration: dict,
+    migrate: bool,
+    job_executor: Executor,
+) -> inventory.Inventory:
+    """Open a database and build the caches and job manager working on it"""
+    database_config: dict = configuration.get("database", {})
+    jobs_config: dict = configuration.get("jobs", {})
+    part_sorter = sorter.PartSorter(database_url)
+    if migrate:
+        part_sorter.upgrade_tables()
+    elif database_config.get("create_tables", False):
+        part_sorter.create_tables()
+    write_batching: dict = database_config.get("write_batching", {})
+    if write_batching.get("enabled", False):
+        part_sorter.enable_write_batching(
+            max_batch=int(write_batching.get("max_batch", 64)),
+            max_delay=float(write_batching.get("max_delay_ms", 5)) / 1000,
+        )
+    read_replica: dict = database_config.get("read_replica", {})
+    if read_replica.get("enabled", False):
+        part_sorter.enable_read_replica(
+            max_staleness=float(read_replica.get("max_staleness_ms", 0)) / 1000,
+        )
+
+    suggest_index = suggest.PrefixIndex()
+    part_sorter.add_listener(suggest_index.apply)
+    suggest_index.ensure_current(part_sorter.get_revision(), part_sorter.get_part_search_terms)
+    job_manager = jobs.JobManager(
+        part_sorter,
+        job_executor,
+        max_queued=int(jobs_config.get("max_queued", 16)),
+        defaults={
+            key: int(jobs_config[key])
+            for key in ("batch_size", "max_image_bytes")
+            if key in jobs_config
+        },
+    )
+    return inventory.Inventory(
+        name, part_sorter, create_snapshots(part_sorter), suggest_index, job_manager
+    )
+
+
+def create_registry(
+    inventories_config: dict, configuration: dict, job_executor: Executor
+) -> inventory.InventoryRegistry:
+    """Open every inventory as `{directory}/{name}.sqlite`, migrated on first use"""
+    directory = str(inventories_config.get("directory", "inventories"))
+    create = bool(inventories_config.get("create", False))
+    if create:
+        os.makedirs(directory, exist_ok=True)
+
+    def open_named(name: str) -> inventory.Inventory:
+        path = os.path.join(directory, f"{name}.sqlite")
+        if not create and not os.path.exists(path):
+            raise inventory.InventoryNameInvalidException(f"Inventory {name} does not exist")
+        return open_inventory(
+            name, f"sqlite:///{path}", configuration, migrate=True, job_executor=job_executor
+        )
+
+    return inventory.InventoryRegistry(
+        open_named,
+        max_open=int(inventories_config.get("max_open", 8)),
+        idle_timeout=float(inventories_config.get("idle_timeout_s", 600)),
+    )
+
+
+def rollup_history(app: FastAPI, retention: dict):
+    """Fold quantity changes into history buckets and expire old ones"""
+    registry: inventory.InventoryRegistry | None = app.state.inventories
+    if registry is None:
+        app.state.inventory.part_sorter.rollup_quantity_history(**retention)
+        return
+    # Closed inventories have no new changes, they catch up once reopened
+    with registry.use_open() as inventories:
+        for selected in inventories:
+            selected.part_sorter.rollup_quantity_history(**retention)
+
+
+async def run_periodically(interval: float, job: Callable, *args):
+    """Run a blocking job in the threadpool every `interval` seconds until cancelled"""
+    while True:
         try:
-            res = await client.post(
-                urllib.parse.urljoin(response.api, "/identify"),
-                json={"location": response.location},
-            )
-            res.raise_for_status()  # Raise an exception for 4xx/5xx responses
-            return res.json()
-        except httpx.HTTPStatusError as exc:
-            raise HTTPException(
-                status_code=exc.response.status_code, detail=exc.response.text
-            )
-        except Exception as exc:
-            raise HTTPException(status_code=500, detail=str(exc))
+            await run_in_threadpool(job, *args)
+        except Exception as e:
+            logger.error(f"Periodic job {job.__name__} failed: {repr(e)}")
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    import httpx
+
+    started = time.perf_counter()
+    configuration: dict = app.state.config
+    database_config: dict = configuration.get("database", {})
+    server_config: dict = configuration.get("server", {})
+    history_config: dict = configuration.get("history", {})
+    inventories_config: dict = configuration.get("inventories", {})
+    jobs_config: dict = configuration.get("jobs", {})
+
+    # Shared by every inventory, so maintenance never takes more than these threads
+    job_executor = ThreadPoolExecutor(
+        max_workers=int(jobs_config.get("workers", 2)), thread_name_prefix="jobs"
+    )
+    tasks = []
+    app.state.inventory = None
+    app.state.inventories = None
+    if inventories_config.get("enabled", False):
+        app.state.inventories = create_registry(inventories_config, configuration, job_executor)
+        app.state.default_inventory = inventories_config.get("default")
+        idle_timeout = float(inventories_config.get("idle_timeout_s", 600))
+        tasks.append(
+            run_periodically(min(idle_timeout / 2, 60), app.state.inventories.evict_idle)
+        )
+    else:
+        # Databases made with create_tables have no migration history
+        migrate = database_config.get("migrate", not database_config.get("create_tables", False))
+        app.state.inventory = await run_in_threadpool(
+            open_inventory,
+            "default",
+            database_config.get("url", DEFAULT_DATABASE_URL),
+            configuration,
+            bool(migrate),
+            job_executor,
+        )
+    app.state.http_client = httpx.AsyncClient()
+
+    rollup_interval = float(history_config.get("rollup_interval_s", 300))
+    if rollup_interval > 0:
+        retention = {
+            key: float(history_config[key])
+            for key in ("raw_retention_days", "hour_retention_days", "day_retention_days")
+            if key in history_config
+        }
+        tasks.append(run_periodically(rollup_interval, rollup_history, app, retention))
+    tasks = [asyncio.create_task(task) for task in tasks]
+
+    if server_config.get("warmup", False) and app.state.inventory is not None:
+        await run_in_threadpool(
+            warmup, app.state.inventory.part_sorter, app.state.inventory.snapshots
+        )
 
+    app.state.startup_seconds = time.perf_counter() - started
+    logger.info(
+        f"Worker started in {app.state.startup_seconds * 1000:.1f} ms "
+        f"(main imported in {IMPORT_SECONDS * 1000:.1f} ms)"
+    )
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await app.state.http_client.aclose()
+        if app.state.inventories is not None:
+            app.state.inventories.close()
+        else:
+            app.state.inventory.close()
+        job_executor.shutdown(wait=True)
+
+
+def create_app(configuration: dict | None = None) -> FastAPI:
+    """Build an application instance
+
+    Nothing touches the database until the lifespan starts, so tests can
+    create cheap instances with their own `database.url`.
+    """
+    if configuration is None:
+        configuration = load_config()
+    configure_logging(configuration)
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.config = configuration
+
+    origins = [
+        "*",
+    ]
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    if configuration.get("inventories", {}).get("enabled", False):
+        app.add_middleware(inventory.InventoryPathMiddleware)
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str):
+    # Keep `uvicorn main:app` working without building the app on import
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host=server_host, port=server_port)
+    server_config: dict = load_config().get("server", {})
+    server_port: int = int(server_config.get("port", 8000))
+    server_host: str = str(server_config.get("host", "0.0.0.0"))
+    # Every worker is a separate process with its own engine and caches
+    server_workers: int = int(server_config.get("workers", 1))
+
+    uvicorn.run(
+        "main:create_app",
+        factory=True,
+        host=server_host,
+        port=server_port,
+        workers=server_workers,
+    )
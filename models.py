@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, LargeBinary, Text, ForeignKey
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, LargeBinary, Text, ForeignKey, Index, DDL, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -16,8 +16,9 @@ class Location(Base):
     attrs = Column(Text, nullable=False)
     
     # Relationships
-    sorters = relationship("Sorter", back_populates="location_ref", cascade="all, delete-orphan")
-    parts = relationship("Part", back_populates="location_ref")
+    # Children are removed by ON DELETE CASCADE, the ORM does not load them to delete
+    sorters = relationship("Sorter", back_populates="location_ref", cascade="all, delete-orphan", passive_deletes=True)
+    parts = relationship("Part", back_populates="location_ref", passive_deletes=True)
     
     @property
     def attributes(self):
@@ -36,7 +37,7 @@ class Sorter(Base):
     __tablename__ = 'sorters'
     
     id = Column(String, primary_key=True)
-    location = Column(String, ForeignKey('locations.id'), nullable=False)
+    location = Column(String, ForeignKey('locations.id', ondelete='CASCADE'), nullable=False, index=True)
     name = Column(String, nullable=False)
     icon = Column(String, nullable=False)
     tags = Column(String)
@@ -44,7 +45,7 @@ class Sorter(Base):
     
     # Relationships
     location_ref = relationship("Location", back_populates="sorters")
-    parts = relationship("Part", back_populates="sorter_ref", cascade="all, delete-orphan")
+    parts = relationship("Part", back_populates="sorter_ref", cascade="all, delete-orphan", passive_deletes=True)
     
     @property
     def attributes(self):
@@ -63,7 +64,7 @@ class Part(Base):
     __tablename__ = 'parts'
     
     id = Column(String, primary_key=True)
-    sorter = Column(String, ForeignKey('sorters.id'), nullable=False)
+    sorter = Column(String, ForeignKey('sorters.id', ondelete='CASCADE'), nullable=False, index=True)
     name = Column(String, nullable=False)
     image = Column(LargeBinary)
     image_hash = Column(LargeBinary)
@@ -73,7 +74,7 @@ class Part(Base):
     enable_quantity = Column(Boolean, nullable=False, default=True)
     price = Column(Float(precision=10), nullable=False, default=0.00)
     notes = Column(Text)
-    location = Column(String, ForeignKey('locations.id'), nullable=False)
+    location = Column(String, ForeignKey('locations.id', ondelete='CASCADE'), nullable=False, index=True)
     created_at = Column(DateTime, default=func.current_timestamp())
     updated_at = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())
     attrs = Column(Text, nullable=False)
@@ -93,4 +94,79 @@ class Part(Base):
     
     @attributes.setter
     def attributes(self, value):
-        self.attrs = json.dumps(value) if value else "{}"
\ No newline at end of file
+        self.attrs = json.dumps(value) if value else "{}"
+
+class Revision(Base):
+    """Single row counter bumped by every write transaction, see PartSorter.get_revision"""
+    __tablename__ = 'revision'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+class PartQuantityEvent(Base):
+    """Raw quantity changes, written by the triggers below in the same transaction"""
+    __tablename__ = 'part_quantity_events'
+
+    id = Column(Integer, primary_key=True)
+    part_id = Column(String, ForeignKey('parts.id', ondelete='CASCADE'), nullable=False)
+    ts = Column(Integer, nullable=False)  # unix seconds
+    quantity = Column(Integer, nullable=False)
+    delta = Column(Integer, nullable=False)
+
+    # Per part for history reads, by time alone for rollups and retention
+    __table_args__ = (
+        Index('ix_part_quantity_events_part_id_ts', 'part_id', 'ts'),
+        Index('ix_part_quantity_events_ts', 'ts'),
+    )
+
+class PartQuantityRollup(Base):
+    """Quantity history downsampled into 'hour' and 'day' buckets"""
+    __tablename__ = 'part_quantity_rollups'
+
+    part_id = Column(String, ForeignKey('parts.id', ondelete='CASCADE'), primary_key=True)
+    bucket = Column(String, primary_key=True)
+    start = Column(Integer, primary_key=True)  # unix seconds
+    open_quantity = Column(Integer, nullable=False)
+    close_quantity = Column(Integer, nullable=False)
+    min_quantity = Column(Integer, nullable=False)
+    max_quantity = Column(Integer, nullable=False)
+    added = Column(Integer, nullable=False)
+    consumed = Column(Integer, nullable=False)
+    events = Column(Integer, nullable=False)
+
+    # Rollups and retention work on one bucket across all parts
+    __table_args__ = (Index('ix_part_quantity_rollups_bucket_start', 'bucket', 'start'),)
+
+class Job(Base):
+    """Background maintenance jobs, see JobManager"""
+    __tablename__ = 'jobs'
+
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False)  # queued, running, succeeded, failed or cancelled
+    params = Column(Text, nullable=False)
+    processed = Column(Integer, nullable=False, default=0)
+    total = Column(Integer)
+    result = Column(Text)
+    error = Column(Text)
+    created_at = Column(DateTime, default=func.current_timestamp())
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    owner = Column(String)  # process that queued and runs the job, see jobs.process_owner
+
+QUANTITY_HISTORY_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS parts_quantity_insert AFTER INSERT ON parts
+    BEGIN
+        INSERT INTO part_quantity_events (part_id, ts, quantity, delta)
+        VALUES (new.id, CAST(strftime('%%s', 'now') AS INTEGER), new.quantity, new.quantity);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS parts_quantity_update AFTER UPDATE OF quantity ON parts
+    WHEN old.quantity IS NOT new.quantity
+    BEGIN
+        INSERT INTO part_quantity_events (part_id, ts, quantity, delta)
+        VALUES (new.id, CAST(strftime('%%s', 'now') AS INTEGER), new.quantity, new.quantity - old.quantity);
+    END""",
+]
+
+for trigger in QUANTITY_HISTORY_TRIGGERS:
+    event.listen(PartQuantityEvent.__table__, "after_create", DDL(trigger))
\ No newline at end of file
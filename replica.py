@@ -0,0 +1,133 @@
+import itertools
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+from loguru import logger
+from sqlalchemy import create_engine, Engine
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool
+
+_generations = itertools.count()
+
+
+class ReadReplica:
+    """In-memory copy of a SQLite database file for serving reads
+
+    Copies are made with the online backup API into a fresh in-memory
+    database (memdb VFS) and swapped in once complete, together with an
+    engine that only connects to that copy, so readers always see one
+    consistent revision and never wait for a refresh. A background thread
+    makes a new copy after every change this process commits (see
+    `mark_stale`) and polls for commits from other processes.
+
+    The replica is used while it is at the latest known revision, or for up
+    to `max_staleness` seconds after it fell behind; past that, reads should
+    go to the primary database until the next copy is ready. Checking this
+    never touches the database file, so reads do not wait for a writer.
+    Commits from other processes become known within the polling interval.
+    """
+
+    def __init__(self, database: str, get_revision: Callable[[], int], max_staleness: float = 0):
+        self.database = database
+        self.get_revision = get_revision
+        self.max_staleness = max_staleness
+        self.revision: int | None = None
+        self.latest_revision = 0
+        self.engine: Engine | None = None
+        self.SessionLocal: sessionmaker | None = None
+        self._holder: sqlite3.Connection | None = None
+        self._stale_since: float | None = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name="read-replica", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _create_engine(name: str) -> Engine:
+        def connect() -> sqlite3.Connection:
+            connection = sqlite3.connect(
+                f"file:/{name}?vfs=memdb", uri=True, check_same_thread=False
+            )
+            connection.execute("PRAGMA query_only=ON")
+            return connection
+
+        return create_engine("sqlite://", creator=connect, poolclass=QueuePool)
+
+    def get_session(self) -> Session:
+        return self.SessionLocal()
+
+    def refresh(self):
+        """Copy the database into a new in-memory database and switch reads to it"""
+        started = time.perf_counter()
+        name = f"replica-{id(self)}-{next(_generations)}"
+        copy = sqlite3.connect(f"file:/{name}?vfs=memdb", uri=True, check_same_thread=False)
+        with sqlite3.connect(self.database) as source:
+            source.backup(copy)
+        rows = copy.execute("SELECT value FROM revision WHERE id = 1").fetchall()
+        engine = self._create_engine(name)
+
+        previous_engine, previous_holder = self.engine, self._holder
+        with self._lock:
+            # Sessions are switched before the revision, so nobody can pair the
+            # new revision with a pooled connection to the previous copy. The
+            # holder keeps the in-memory database alive between reads.
+            self.engine, self._holder = engine, copy
+            self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            self.revision = rows[0][0] if rows else 0
+            if self.revision >= self.latest_revision:
+                self.latest_revision = self.revision
+                self._stale_since = None
+        # Readers still on the previous copy keep it alive until they close
+        if previous_engine is not None:
+            previous_engine.dispose()
+        if previous_holder is not None:
+            previous_holder.close()
+        logger.debug(
+            f"Refreshed read replica at revision {self.revision} "
+            f"in {(time.perf_counter() - started) * 1000:.1f} ms"
+        )
+
+    def mark_stale(self, _changes, revision: int):
+        """Note that the primary reached `revision`, usable as a PartSorter listener"""
+        with self._lock:
+            if revision <= self.revision:
+                return
+            self.latest_revision = max(self.latest_revision, revision)
+            if self._stale_since is None:
+                self._stale_since = time.monotonic()
+        self._wake.set()
+
+    def is_fresh(self) -> bool:
+        """Whether reads may be served from the replica right now"""
+        if self.revision >= self.latest_revision:
+            return True
+        stale_since = self._stale_since
+        return stale_since is not None and time.monotonic() - stale_since <= self.max_staleness
+
+    def _run(self):
+        # Poll often enough to notice other processes' commits within the bound
+        poll_interval = max(self.max_staleness / 2, 0.05)
+        while not self._stopped:
+            self._wake.wait(timeout=poll_interval)
+            self._wake.clear()
+            if self._stopped:
+                break
+            try:
+                self.mark_stale(None, self.get_revision())
+                if self.revision < self.latest_revision:
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh read replica: {repr(e)}")
+
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+        self.engine.dispose()
+        if self._holder is not None:
+            self._holder.close()
@@ -0,0 +1,123 @@
+import gzip
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional
+
+from loguru import logger
+from pydantic import TypeAdapter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Preferred order when the client accepts several encodings equally
+ENCODING_PREFERENCE = ["zstd", "br", "gzip", "identity"]
+
+
+def _compress(encoding: str, data: bytes) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def available_encodings() -> List[str]:
+    encodings = ["identity", "gzip"]
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def choose_encoding(accept_encoding: str | None, available: List[str]) -> str:
+    """Pick the best content encoding for an Accept-Encoding header"""
+    if not accept_encoding:
+        return "identity"
+
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            weights[name] = quality
+
+    def weight(encoding: str) -> float:
+        if encoding in weights:
+            return weights[encoding]
+        if "*" in weights:
+            return weights["*"]
+        # identity is acceptable unless explicitly refused
+        return 0.001 if encoding == "identity" else 0.0
+
+    candidates = [e for e in ENCODING_PREFERENCE if e in available and weight(e) > 0]
+    if not candidates:
+        return "identity"
+    return max(candidates, key=lambda e: (weight(e), -ENCODING_PREFERENCE.index(e)))
+
+
+class Snapshot:
+    def __init__(self, revision: int, payload: bytes, encodings: List[str]):
+        self.revision = revision
+        self.etag = f'"{hashlib.blake2b(payload, digest_size=16).hexdigest()}"'
+        self.payloads = {encoding: _compress(encoding, payload) for encoding in encodings}
+
+
+class SnapshotCache:
+    """Serialized and pre-compressed copies of full collections
+
+    A snapshot is rebuilt lazily on the first read after the revision reported
+    by `get_revision` changes, so reads between writes never touch the database.
+    """
+
+    def __init__(self, get_revision: Callable[[], int]):
+        self.get_revision = get_revision
+        self.encodings = available_encodings()
+        self._loaders: Dict[str, Callable[[], list]] = {}
+        self._adapters: Dict[str, TypeAdapter] = {}
+        self._snapshots: Dict[str, Snapshot] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+
+    def register(self, name: str, loader: Callable[[], list], adapter: TypeAdapter):
+        self._loaders[name] = loader
+        self._adapters[name] = adapter
+        self._locks[name] = threading.Lock()
+
+    def get(self, name: str) -> Snapshot:
+        snapshot: Optional[Snapshot] = self._snapshots.get(name)
+        revision = self.get_revision()
+        if snapshot is not None and snapshot.revision == revision:
+            return snapshot
+
+        with self._locks[name]:
+            # Another thread may have rebuilt it while we were waiting
+            snapshot = self._snapshots.get(name)
+            revision = self.get_revision()
+            if snapshot is not None and snapshot.revision == revision:
+                return snapshot
+
+            adapter = self._adapters[name]
+            payload = adapter.dump_json(adapter.validate_python(self._loaders[name]()))
+            snapshot = Snapshot(revision, payload, self.encodings)
+            self._snapshots[name] = snapshot
+            logger.debug(
+                f"Rebuilt {name} snapshot at revision {revision} ({len(payload)} bytes)"
+            )
+            return snapshot
@@ -1,10 +1,82 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.exc import SQLAlchemyError
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import create_engine, delete, event, or_, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.sql import func
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import sessionmaker, Session, selectinload, defer
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.pool import StaticPool
 from loguru import logger
-from models import Base, Location, Sorter, Part
+from models import Base, Location, Sorter, Part, Revision, PartQuantityEvent, PartQuantityRollup
+import images
+from replica import ReadReplica
+from writequeue import WriteBatcher
 import json
-from typing import List, Dict, Optional
+from typing import Any, Callable, Iterator, List, Dict, Optional
+
+HISTORY_BUCKETS = {'hour': 3600, 'day': 86400}
+
+# Recomputes every `bucket` rollup starting at or after :since from the rows
+# in `source`. The first and last row of a bucket give its open and close quantity.
+# Grouping by start first keeps SQLite on the ts index instead of scanning every
+# event in (part_id, ts) order.
+_ROLLUP_FROM_EVENTS = """
+WITH buckets AS (
+    SELECT part_id, ts - ts % :size AS start,
+           MIN(quantity) AS min_quantity, MAX(quantity) AS max_quantity,
+           SUM(MAX(delta, 0)) AS added, SUM(MAX(-delta, 0)) AS consumed,
+           COUNT(*) AS events, MIN(id) AS first_id, MAX(id) AS last_id
+    FROM part_quantity_events
+    WHERE ts >= :since
+    GROUP BY start, part_id
+)
+INSERT INTO part_quantity_rollups (
+    part_id, bucket, start, open_quantity, close_quantity,
+    min_quantity, max_quantity, added, consumed, events
+)
+SELECT b.part_id, :bucket, b.start, first.quantity - first.delta, last.quantity,
+       b.min_quantity, b.max_quantity, b.added, b.consumed, b.events
+FROM buckets b
+JOIN part_quantity_events first ON first.id = b.first_id
+JOIN part_quantity_events last ON last.id = b.last_id
+WHERE true
+ON CONFLICT (part_id, bucket, start) DO UPDATE SET
+    open_quantity = excluded.open_quantity, close_quantity = excluded.close_quantity,
+    min_quantity = excluded.min_quantity, max_quantity = excluded.max_quantity,
+    added = excluded.added, consumed = excluded.consumed, events = excluded.events
+"""
+
+_ROLLUP_FROM_ROLLUPS = """
+WITH buckets AS (
+    SELECT part_id, start - start % :size AS bucket_start,
+           MIN(min_quantity) AS min_quantity, MAX(max_quantity) AS max_quantity,
+           SUM(added) AS added, SUM(consumed) AS consumed, SUM(events) AS events,
+           MIN(start) AS first_start, MAX(start) AS last_start
+    FROM part_quantity_rollups
+    WHERE bucket = :source AND start >= :since
+    GROUP BY part_id, bucket_start
+)
+INSERT INTO part_quantity_rollups (
+    part_id, bucket, start, open_quantity, close_quantity,
+    min_quantity, max_quantity, added, consumed, events
+)
+SELECT b.part_id, :bucket, b.bucket_start, first.open_quantity, last.close_quantity,
+       b.min_quantity, b.max_quantity, b.added, b.consumed, b.events
+FROM buckets b
+JOIN part_quantity_rollups first
+    ON first.part_id = b.part_id AND first.bucket = :source AND first.start = b.first_start
+JOIN part_quantity_rollups last
+    ON last.part_id = b.part_id AND last.bucket = :source AND last.start = b.last_start
+WHERE true
+ON CONFLICT (part_id, bucket, start) DO UPDATE SET
+    open_quantity = excluded.open_quantity, close_quantity = excluded.close_quantity,
+    min_quantity = excluded.min_quantity, max_quantity = excluded.max_quantity,
+    added = excluded.added, consumed = excluded.consumed, events = excluded.events
+"""
 
 
 class SorterIdInvalidException(Exception):
@@ -13,47 +85,276 @@ class SorterIdInvalidException(Exception):
 
 class PartSorter:
     def __init__(self, database_url: str = "sqlite:///partsdb.sqlite"):
-        self.engine = create_engine(database_url)
+        if database_url in ("sqlite://", "sqlite:///:memory:"):
+            # Share one in-memory database between threads instead of one per thread
+            self.engine = create_engine(
+                database_url,
+                connect_args={"check_same_thread": False},
+                poolclass=StaticPool,
+            )
+        else:
+            self.engine = create_engine(database_url)
+        event.listen(self.engine, "connect", self._enable_foreign_keys)
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-        
+        self._revision = 0
+        self._revision_lock = threading.Lock()
+        self._listeners: List[Callable[[List[tuple], int], None]] = []
+        event.listen(self.SessionLocal, "before_commit", self._bump_revision)
+        event.listen(self.SessionLocal, "after_commit", self._publish_changes)
+        event.listen(self.SessionLocal, "after_rollback", self._discard_changes)
+
+        # The shared revision row is read through a connection this process never
+        # writes with, so commits from other processes (e.g. other uvicorn workers)
+        # are seen as well
+        self._watcher: sqlite3.Connection | None = None
+        database = self.engine.url.database
+        if self.engine.dialect.name == "sqlite" and database and database != ":memory:":
+            self._watcher = sqlite3.connect(database, check_same_thread=False)
+
+        self.write_batcher: WriteBatcher | None = None
+        self.read_replica: ReadReplica | None = None
+
     def get_session(self) -> Session:
         return self.SessionLocal()
-    
+
+    def get_read_session(self) -> Session:
+        """Get a session for reads only, served from the read replica when it is fresh enough"""
+        if self.read_replica is not None and self.read_replica.is_fresh():
+            return self.read_replica.get_session()
+        return self.get_session()
+
+    def get_read_revision(self) -> int:
+        """Get the revision that get_read_session currently reads at"""
+        if self.read_replica is not None and self.read_replica.is_fresh():
+            return self.read_replica.revision
+        return self.get_revision()
+
+    @staticmethod
+    def _enable_foreign_keys(dbapi_connection, _connection_record):
+        # SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    @staticmethod
+    def _record(session: Session, *change):
+        """Note a change made by a write operation, published once it commits
+
+        Changes are tuples of (kind, id, ...), see add_listener.
+        """
+        session.info.setdefault("changes", []).append(change)
+
+    def _bump_revision(self, session: Session):
+        if not session.info.get("changes"):
+            return
+        statement = sqlite_insert(Revision).values(id=1, value=1)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Revision.id], set_={'value': Revision.value + 1}
+        ).returning(Revision.value)
+        session.info["revision"] = session.execute(statement).scalar_one()
+
+    def _publish_changes(self, session: Session):
+        changes = session.info.pop("changes", None)
+        revision = session.info.pop("revision", None)
+        if not changes:
+            return
+
+        with self._revision_lock:
+            self._revision = max(self._revision, revision)
+        for listener in self._listeners:
+            try:
+                listener(changes, revision)
+            except Exception as e:
+                logger.error(f"Change listener {listener!r} failed: {repr(e)}")
+
+    @staticmethod
+    def _discard_changes(session: Session):
+        session.info.pop("changes", None)
+        session.info.pop("revision", None)
+
+    def add_listener(self, listener: Callable[[List[tuple], int], None]):
+        """Call `listener(changes, revision)` after every commit made by this process
+
+        `changes` lists what the transaction did, e.g. ("part", id, name, tags),
+        ("part_deleted", id) or ("sorter_deleted", id), and `revision` is the
+        new value of the shared revision counter.
+        """
+        self._listeners.append(listener)
+
+    def get_revision(self) -> int:
+        """Get a counter that changes every time data is committed by any process"""
+        if self._watcher is None:
+            return self._revision
+
+        with self._revision_lock:
+            rows = self._watcher.execute("SELECT value FROM revision WHERE id = 1").fetchall()
+        return rows[0][0] if rows else 0
+
+    def warmup(self):
+        """Open a pooled connection so the first request does not pay for it"""
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("SELECT 1")
+
+    def enable_write_batching(self, max_batch: int = 64, max_delay: float = 0.005):
+        """Commit writes from concurrent callers together, see WriteBatcher"""
+        self.write_batcher = WriteBatcher(
+            self.get_session,
+            max_batch=max_batch,
+            max_delay=max_delay,
+            expected_errors=(SorterIdInvalidException,),
+        )
+
+    def enable_read_replica(self, max_staleness: float = 0):
+        """Serve reads from an in-memory copy of the database, see ReadReplica"""
+        if self._watcher is None:
+            logger.warning("Read replica needs a database file, reading from the database instead")
+            return
+        self.read_replica = ReadReplica(self.engine.url.database, self.get_revision, max_staleness)
+        self.add_listener(self.read_replica.mark_stale)
+
+    def _write(self, operation: Callable[[Session], Any]) -> Any:
+        """Run a write operation and commit it, or hand it to the write batcher"""
+        if self.write_batcher is not None:
+            return self.write_batcher.submit(operation).result()
+
+        with self.get_session() as session:
+            result = operation(session)
+            session.commit()
+            return result
+
+    def close(self):
+        if self.write_batcher is not None:
+            self.write_batcher.stop()
+            self.write_batcher = None
+        if self.read_replica is not None:
+            self.read_replica.close()
+            self.read_replica = None
+        if self._watcher is not None:
+            self._watcher.close()
+        self.engine.dispose()
+
+    @staticmethod
+    def _update_row(
+        session: Session, model, uid: str, values: Dict, *returning
+    ) -> Optional[Row]:
+        """Update one row by id in a single statement
+
+        Returns the `returning` columns of the updated row, or None if it does not exist.
+        """
+        columns = returning or (model.id,)
+        if not values:
+            return session.execute(select(*columns).where(model.id == uid)).first()
+        return session.execute(
+            update(model).where(model.id == uid).values(**values).returning(*columns)
+        ).first()
+
     def create_tables(self):
         """Create tables using SQLAlchemy models (use alembic upgrade instead)"""
         Base.metadata.create_all(bind=self.engine)
         logger.info("Tables created using SQLAlchemy models")
 
+    def upgrade_tables(self, lock_timeout: float = 600):
+        """Run alembic migrations up to the latest revision
+
+        All migrations run in one transaction that takes the write lock up
+        front, so workers starting together wait (up to `lock_timeout`
+        seconds) for the first one and then find the database up to date.
+        """
+        from alembic import command
+        from alembic.config import Config
+
+        current_dir = os.path.dirname(os.path.realpath(__file__))
+        config = Config(os.path.join(current_dir, "alembic.ini"))
+        config.set_main_option("script_location", os.path.join(current_dir, "alembic"))
+        with self.engine.connect() as connection:
+            dbapi_connection = connection.connection.driver_connection
+            isolation_level = dbapi_connection.isolation_level
+            busy_timeout = dbapi_connection.execute("PRAGMA busy_timeout").fetchone()[0]
+            # Otherwise pysqlite commits before every DDL statement
+            dbapi_connection.isolation_level = None
+            # Batch migrations copy and drop tables, which must not cascade
+            dbapi_connection.execute("PRAGMA foreign_keys=OFF")
+            dbapi_connection.execute(f"PRAGMA busy_timeout={int(lock_timeout * 1000)}")
+            try:
+                with connection.begin():
+                    connection.exec_driver_sql("BEGIN IMMEDIATE")
+                    config.attributes["connection"] = connection
+                    command.upgrade(config, "head")
+            finally:
+                dbapi_connection.execute(f"PRAGMA busy_timeout={busy_timeout}")
+                dbapi_connection.execute("PRAGMA foreign_keys=ON")
+                dbapi_connection.isolation_level = isolation_level
+        logger.info(f"Database {self.engine.url.database} migrated to the latest revision")
+
     # Location methods
     def create_location(self, uid: str, name: str, icon: str, tags: str, attributes: dict):
-        with self.get_session() as session:
-            if session.query(Location).filter(Location.id == uid).first():
+        def operation(session: Session):
+            result = session.execute(
+                sqlite_insert(Location)
+                .values(id=uid, name=name, icon=icon, tags=tags, attrs=json.dumps(attributes))
+                .on_conflict_do_nothing(index_elements=[Location.id])
+            )
+            if not result.rowcount:
                 raise SorterIdInvalidException(f"Another location with id: {uid} already exists")
-            
-            location = Location(
-                id=uid,
-                name=name,
-                icon=icon,
-                tags=tags,
-                attrs=json.dumps(attributes)
+            self._record(session, "location", uid)
+
+        self._write(operation)
+        logger.info(f"Created new location with id: {uid}")
+
+    def upsert_location(self, uid: str, name: str, icon: str, tags: str, attributes: dict):
+        def operation(session: Session):
+            statement = sqlite_insert(Location).values(
+                id=uid, name=name, icon=icon, tags=tags, attrs=json.dumps(attributes)
             )
-            session.add(location)
-            session.commit()
-            logger.info(f"Created new location with id: {uid}")
+            session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[Location.id],
+                    set_={
+                        'name': statement.excluded.name,
+                        'icon': statement.excluded.icon,
+                        'tags': statement.excluded.tags,
+                        'attrs': statement.excluded.attrs,
+                    },
+                )
+            )
+            self._record(session, "location", uid)
 
-    def delete_location(self, uid: str):
-        with self.get_session() as session:
-            location = session.query(Location).filter(Location.id == uid).first()
-            if not location:
+        self._write(operation)
+        logger.info(f"Upserted location with id: {uid}")
+
+    def delete_location(self, uid: str) -> Dict[str, int]:
+        """Delete a location, its sorters and their parts
+
+        Children are removed by ON DELETE CASCADE in the database, so nothing
+        is loaded into the session. Returns the number of rows removed per table.
+        """
+        def operation(session: Session):
+            sorter_ids = select(Sorter.id).where(Sorter.location == uid)
+            sorter_count = session.scalar(
+                select(func.count()).select_from(Sorter).where(Sorter.location == uid)
+            )
+            part_count = session.scalar(
+                select(func.count()).select_from(Part).where(
+                    or_(Part.location == uid, Part.sorter.in_(sorter_ids))
+                )
+            )
+
+            result = session.execute(delete(Location).where(Location.id == uid))
+            if not result.rowcount:
                 raise SorterIdInvalidException(f"Location with id: {uid} does not exist")
-            
-            session.delete(location)
-            session.commit()
-            logger.info(f"Deleted location with id: {uid}")
+            self._record(session, "location_deleted", uid)
+            return {'locations': 1, 'sorters': sorter_count, 'parts': part_count}
+
+        deleted = self._write(operation)
+        logger.info(
+            f"Deleted location with id: {uid} "
+            f"({deleted['sorters']} sorters, {deleted['parts']} parts)"
+        )
+        return deleted
 
     def get_locations(self) -> List[Dict]:
         try:
-            with self.get_session() as session:
+            with self.get_read_session() as session:
                 locations = session.query(Location).all()
                 result = []
                 for location in locations:
@@ -72,7 +373,7 @@ class PartSorter:
 
     def get_location_ids(self) -> List[str]:
         try:
-            with self.get_session() as session:
+            with self.get_read_session() as session:
                 location_ids = session.query(Location.id).all()
                 return [lid[0] for lid in location_ids]
         except SQLAlchemyError as e:
@@ -87,37 +388,118 @@ class PartSorter:
         tags: str | None = None,
         attributes: dict | None = None,
     ):
-        with self.get_session() as session:
-            location = session.query(Location).filter(Location.id == uid).first()
-            if not location:
+        values = {}
+        if name is not None:
+            values['name'] = name
+        if icon is not None:
+            values['icon'] = icon
+        if tags is not None:
+            values['tags'] = tags
+        if attributes is not None:
+            values['attrs'] = json.dumps(attributes)
+
+        def operation(session: Session):
+            if self._update_row(session, Location, uid, values) is None:
                 raise SorterIdInvalidException(f"Location with id: {uid} does not exist")
-            
-            if name is not None:
-                location.name = name
-            if icon is not None:
-                location.icon = icon
-            if tags is not None:
-                location.tags = tags
-            if attributes is not None:
-                location.attrs = json.dumps(attributes)
-            
-            session.commit()
-            logger.info(f"Updated location with id: {uid}")
+            self._record(session, "location", uid)
+
+        self._write(operation)
+        logger.info(f"Updated location with id: {uid}")
+
+    def get_location_tree(self, uid: str | None = None) -> List[Dict] | None:
+        """Get locations with their nested sorters and parts (without images)
+
+        Loads the whole hierarchy in three queries regardless of size.
+        Returns None if a single location was requested and does not exist.
+        """
+        try:
+            with self.get_read_session() as session:
+                query = session.query(Location).options(
+                    selectinload(Location.sorters)
+                    .selectinload(Sorter.parts)
+                    .options(defer(Part.image), defer(Part.image_hash))
+                )
+                if uid is not None:
+                    query = query.filter(Location.id == uid)
+                locations = query.all()
+                if uid is not None and not locations:
+                    return None
+
+                result = []
+                for location in locations:
+                    sorters = []
+                    for sorter in location.sorters:
+                        parts = []
+                        for part in sorter.parts:
+                            parts.append({
+                                'id': part.id,
+                                'sorter': part.sorter,
+                                'name': part.name,
+                                'tags': part.tags,
+                                'quantity': part.quantity,
+                                'quantity_type': part.quantity_type,
+                                'enable_quantity': part.enable_quantity,
+                                'price': float(part.price) if part.price else 0.0,
+                                'notes': part.notes,
+                                'location': part.location,
+                                'attrs': part.attributes
+                            })
+                        sorters.append({
+                            'id': sorter.id,
+                            'location': sorter.location,
+                            'name': sorter.name,
+                            'icon': sorter.icon,
+                            'tags': sorter.tags,
+                            'attrs': sorter.attributes,
+                            'parts': parts
+                        })
+                    result.append({
+                        'id': location.id,
+                        'name': location.name,
+                        'icon': location.icon,
+                        'tags': location.tags,
+                        'attrs': location.attributes,
+                        'sorters': sorters
+                    })
+                return result
+        except SQLAlchemyError as e:
+            logger.error(f"Experienced error getting location tree, returning empty list: {repr(e)}")
+            return []
 
     # Sorter methods
     def create_sorter(
         self, uid: str, location: str, name: str, icon: str, tags: str, attributes: dict
     ):
-        with self.get_session() as session:
-            if not session.query(Location).filter(Location.id == location).first():
+        def operation(session: Session):
+            try:
+                result = session.execute(
+                    sqlite_insert(Sorter)
+                    .values(
+                        id=uid,
+                        location=location,
+                        name=name,
+                        icon=icon,
+                        tags=tags,
+                        attrs=json.dumps(attributes)
+                    )
+                    .on_conflict_do_nothing(index_elements=[Sorter.id])
+                )
+            except IntegrityError:
                 raise SorterIdInvalidException(
                     f"Location ID: {location} not in locations"
                 )
-
-            if session.query(Sorter).filter(Sorter.id == uid).first():
+            if not result.rowcount:
                 raise SorterIdInvalidException(f"Sorter ID: {uid} already exists")
+            self._record(session, "sorter", uid)
+
+        self._write(operation)
+        logger.info(f"Created new sorter with id: {uid}")
 
-            sorter = Sorter(
+    def upsert_sorter(
+        self, uid: str, location: str, name: str, icon: str, tags: str, attributes: dict
+    ):
+        def operation(session: Session):
+            statement = sqlite_insert(Sorter).values(
                 id=uid,
                 location=location,
                 name=name,
@@ -125,23 +507,48 @@ class PartSorter:
                 tags=tags,
                 attrs=json.dumps(attributes)
             )
-            session.add(sorter)
-            session.commit()
-            logger.info(f"Created new sorter with id: {uid}")
+            try:
+                session.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=[Sorter.id],
+                        set_={
+                            'location': statement.excluded.location,
+                            'name': statement.excluded.name,
+                            'icon': statement.excluded.icon,
+                            'tags': statement.excluded.tags,
+                            'attrs': statement.excluded.attrs,
+                        },
+                    )
+                )
+            except IntegrityError:
+                raise SorterIdInvalidException(
+                    f"Location ID: {location} not in locations"
+                )
+            self._record(session, "sorter", uid)
 
-    def delete_sorter(self, uid: str):
-        with self.get_session() as session:
-            sorter = session.query(Sorter).filter(Sorter.id == uid).first()
-            if not sorter:
+        self._write(operation)
+        logger.info(f"Upserted sorter with id: {uid}")
+
+    def delete_sorter(self, uid: str) -> Dict[str, int]:
+        """Delete a sorter and its parts, see delete_location"""
+        def operation(session: Session):
+            part_count = session.scalar(
+                select(func.count()).select_from(Part).where(Part.sorter == uid)
+            )
+
+            result = session.execute(delete(Sorter).where(Sorter.id == uid))
+            if not result.rowcount:
                 raise SorterIdInvalidException(f"Sorter with id: {uid} does not exist")
-            
-            session.delete(sorter)
-            session.commit()
-            logger.info(f"Deleted sorter with id: {uid}")
+            self._record(session, "sorter_deleted", uid)
+            return {'sorters': 1, 'parts': part_count}
+
+        deleted = self._write(operation)
+        logger.info(f"Deleted sorter with id: {uid} ({deleted['parts']} parts)")
+        return deleted
 
     def get_sorters(self) -> List[Dict]:
         try:
-            with self.get_session() as session:
+            with self.get_read_session() as session:
                 sorters = session.query(Sorter).all()
                 result = []
                 for sorter in sorters:
@@ -161,7 +568,7 @@ class PartSorter:
 
     def get_sorter_ids(self) -> List[str]:
         try:
-            with self.get_session() as session:
+            with self.get_read_session() as session:
                 sorter_ids = session.query(Sorter.id).all()
                 return [sid[0] for sid in sorter_ids]
         except SQLAlchemyError as e:
@@ -177,24 +584,29 @@ class PartSorter:
         tags: str | None = None,
         attributes: dict | None = None,
     ):
-        with self.get_session() as session:
-            sorter = session.query(Sorter).filter(Sorter.id == uid).first()
-            if not sorter:
+        values = {}
+        if location is not None:
+            values['location'] = location
+        if name is not None:
+            values['name'] = name
+        if icon is not None:
+            values['icon'] = icon
+        if tags is not None:
+            values['tags'] = tags
+        if attributes is not None:
+            values['attrs'] = json.dumps(attributes)
+
+        def operation(session: Session):
+            try:
+                updated = self._update_row(session, Sorter, uid, values)
+            except IntegrityError:
+                raise SorterIdInvalidException(f"Location ID: {location} not in locations")
+            if updated is None:
                 raise SorterIdInvalidException(f"Sorter with id: {uid} does not exist")
-            
-            if location is not None:
-                sorter.location = location
-            if name is not None:
-                sorter.name = name
-            if icon is not None:
-                sorter.icon = icon
-            if tags is not None:
-                sorter.tags = tags
-            if attributes is not None:
-                sorter.attrs = json.dumps(attributes)
-            
-            session.commit()
-            logger.info(f"Updated sorter with id: {uid}")
+            self._record(session, "sorter", uid)
+
+        self._write(operation)
+        logger.info(f"Updated sorter with id: {uid}")
 
     # Part methods
     def create_part(
@@ -211,62 +623,120 @@ class PartSorter:
         location: str,
         attributes: dict,
     ):
-        with self.get_session() as session:
-            if not session.query(Sorter).filter(Sorter.id == sorter).first():
-                raise SorterIdInvalidException(f"Sorter ID: {sorter} not found")
-
-            if session.query(Part).filter(Part.id == uid).first():
+        def operation(session: Session):
+            try:
+                result = session.execute(
+                    sqlite_insert(Part)
+                    .values(
+                        id=uid,
+                        sorter=sorter,
+                        name=name,
+                        tags=tags,
+                        quantity=quantity,
+                        quantity_type=quantity_type,
+                        enable_quantity=enable_quantity,
+                        price=price,
+                        notes=notes,
+                        location=location,
+                        attrs=json.dumps(attributes)
+                    )
+                    .on_conflict_do_nothing(index_elements=[Part.id])
+                )
+            except IntegrityError:
+                raise self._part_reference_error(session, sorter, location)
+            if not result.rowcount:
                 raise SorterIdInvalidException(f"Part ID: {uid} already exists")
+            self._record(session, "part", uid, name, tags)
 
-            part = Part(
-                id=uid,
-                sorter=sorter,
-                name=name,
-                tags=tags,
-                quantity=quantity,
-                quantity_type=quantity_type,
-                enable_quantity=enable_quantity,
-                price=price,
-                notes=notes,
-                location=location,
-                attrs=json.dumps(attributes)
-            )
-            session.add(part)
-            session.commit()
-            logger.info(f"Created new part with id: {uid}")
+        self._write(operation)
+        logger.info(f"Created new part with id: {uid}")
+
+    def upsert_part(
+        self,
+        uid: str,
+        sorter: str,
+        name: str,
+        quantity: int,
+        quantity_type: str,
+        enable_quantity: bool,
+        tags: str,
+        price: float,
+        notes: str,
+        location: str,
+        attributes: dict,
+    ):
+        def operation(session: Session):
+            try:
+                session.execute(
+                    self._part_upsert_statement(),
+                    {
+                        'id': uid,
+                        'sorter': sorter,
+                        'name': name,
+                        'tags': tags,
+                        'quantity': quantity,
+                        'quantity_type': quantity_type,
+                        'enable_quantity': enable_quantity,
+                        'price': price,
+                        'notes': notes,
+                        'location': location,
+                        'attrs': json.dumps(attributes),
+                    },
+                )
+            except IntegrityError:
+                raise self._part_reference_error(session, sorter, location)
+            self._record(session, "part", uid, name, tags)
+
+        self._write(operation)
+        logger.info(f"Upserted part with id: {uid}")
+
+    @staticmethod
+    def _part_reference_error(
+        session: Session, sorter: str, location: str
+    ) -> SorterIdInvalidException:
+        # Only runs after a failed insert, to tell which reference was missing
+        if session.get(Sorter, sorter) is None:
+            return SorterIdInvalidException(f"Sorter ID: {sorter} not found")
+        return SorterIdInvalidException(f"Location ID: {location} not in locations")
 
     def set_part_image(self, uid: str, image: str | None):
-        with self.get_session() as session:
-            part = session.query(Part).filter(Part.id == uid).first()
-            if not part:
+        values = {'image': None, 'image_hash': None}
+        if image is not None:
+            values['image'] = image.encode('utf-8')
+            values['image_hash'] = images.image_hash(values['image'])
+
+        def operation(session: Session):
+            if self._update_row(session, Part, uid, values) is None:
                 raise SorterIdInvalidException(f"Part with id: {uid} does not exist")
-            
-            part.image = image
-            session.commit()
-            logger.info(f"Updated image for part with id: {uid}")
+            self._record(session, "part_image", uid)
 
-    def delete_part(self, uid: str):
-        with self.get_session() as session:
-            part = session.query(Part).filter(Part.id == uid).first()
-            if not part:
+        self._write(operation)
+        logger.info(f"Updated image for part with id: {uid}")
+
+    def delete_part(self, uid: str) -> Dict[str, int]:
+        def operation(session: Session):
+            result = session.execute(delete(Part).where(Part.id == uid))
+            if not result.rowcount:
                 raise SorterIdInvalidException(f"Part with id: {uid} does not exist")
-            
-            session.delete(part)
-            session.commit()
-            logger.info(f"Deleted part with id: {uid}")
+            self._record(session, "part_deleted", uid)
+
+        self._write(operation)
+        logger.info(f"Deleted part with id: {uid}")
+        return {'parts': 1}
 
-    def get_parts(self) -> List[Dict]:
+    def get_parts(self, include_images: bool = True) -> List[Dict]:
+        """Get all parts, without loading image blobs if `include_images` is False"""
         try:
-            with self.get_session() as session:
-                parts = session.query(Part).all()
+            with self.get_read_session() as session:
+                query = session.query(Part)
+                if not include_images:
+                    query = query.options(defer(Part.image), defer(Part.image_hash))
                 result = []
-                for part in parts:
+                for part in query.all():
                     part_dict = {
                         'id': part.id,
                         'sorter': part.sorter,
                         'name': part.name,
-                        'image': part.image,
-                        'image_hash': part.image_hash,
                         'tags': part.tags,
                         'quantity': part.quantity,
                         'quantity_type': part.quantity_type,
@@ -278,15 +748,118 @@ class PartSorter:
                         'updated_at': part.updated_at,
                         'attrs': part.attributes
                     }
+                    if include_images:
+                        part_dict['image'] = part.image
+                        part_dict['image_hash'] = part.image_hash
                     result.append(part_dict)
                 return result
         except SQLAlchemyError as e:
             logger.error(f"Experienced error getting parts, returning empty list: {repr(e)}")
             return []
 
-    def get_part_ids(self) -> List[str]:
+    @staticmethod
+    def _part_upsert_statement():
+        statement = sqlite_insert(Part)
+        return statement.on_conflict_do_update(
+            index_elements=[Part.id],
+            set_={
+                'sorter': statement.excluded.sorter,
+                'name': statement.excluded.name,
+                'tags': statement.excluded.tags,
+                'quantity': statement.excluded.quantity,
+                'quantity_type': statement.excluded.quantity_type,
+                'enable_quantity': statement.excluded.enable_quantity,
+                'price': statement.excluded.price,
+                'notes': statement.excluded.notes,
+                'location': statement.excluded.location,
+                'attrs': statement.excluded.attrs,
+                'updated_at': func.current_timestamp(),
+            },
+        )
+
+    def upsert_parts(self, parts: List[Dict]) -> int:
+        """Insert or update many parts in a single transaction
+
+        Each dict needs every part column except the image ones, with `attrs`
+        already JSON encoded. References are not checked here.
+        """
+        if not parts:
+            return 0
+
+        def operation(session: Session):
+            session.execute(self._part_upsert_statement(), parts)
+            self._record(session, "parts_bulk", None)
+
+        self._write(operation)
+        logger.debug(f"Upserted {len(parts)} parts")
+        return len(parts)
+
+    def count_part_images(self) -> int:
+        with self.get_session() as session:
+            return session.execute(
+                select(func.count()).select_from(Part).where(Part.image.is_not(None))
+            ).scalar_one()
+
+    def iter_part_images(self, batch_size: int = 200) -> Iterator[List[Row]]:
+        """Yield (id, image, image_hash) of every part with an image, in batches
+
+        Batches are read by id in separate short transactions, so scanning
+        every image neither holds a read lock nor loads all of them at once.
+        """
+        last_id = None
+        while True:
+            query = select(Part.id, Part.image, Part.image_hash).where(Part.image.is_not(None))
+            if last_id is not None:
+                query = query.where(Part.id > last_id)
+            with self.get_session() as session:
+                batch = session.execute(query.order_by(Part.id).limit(batch_size)).all()
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1].id
+
+    def update_part_images(self, rows: List[Dict]) -> int:
+        """Update image columns of many parts in one transaction
+
+        Every dict needs the part `id`, the `old_image` the new values were
+        computed from and the image columns to set. Parts whose image changed
+        or that were deleted since are left alone. Returns how many parts
+        were updated.
+        """
+        if not rows:
+            return 0
+
+        def operation(session: Session) -> int:
+            updated = 0
+            for row in rows:
+                values = {key: value for key, value in row.items() if key not in ('id', 'old_image')}
+                result = session.execute(
+                    update(Part)
+                    .where(Part.id == row['id'], Part.image == row['old_image'])
+                    .values(**values)
+                )
+                if result.rowcount:
+                    updated += 1
+                    self._record(session, "part_image", row['id'])
+            return updated
+
+        updated = self._write(operation)
+        logger.debug(f"Updated images of {updated} of {len(rows)} parts")
+        return updated
+
+    def get_part_search_terms(self) -> List[tuple]:
+        """Get (id, name, tags) of every part, for building search indexes"""
         try:
+            # Indexes are tagged with get_revision(), so this must not read a stale replica
             with self.get_session() as session:
+                return [tuple(row) for row in session.query(Part.id, Part.name, Part.tags).all()]
+        except SQLAlchemyError as e:
+            logger.error(f"Experienced error getting part search terms, returning empty list: {repr(e)}")
+            return []
+
+    def get_part_ids(self) -> List[str]:
+        try:
+            with self.get_read_session() as session:
                 part_ids = session.query(Part.id).all()
                 return [pid[0] for pid in part_ids]
         except SQLAlchemyError as e:
@@ -307,31 +880,153 @@ class PartSorter:
         location: str | None = None,
         attributes: dict | None = None,
     ):
-        with self.get_session() as session:
-            part = session.query(Part).filter(Part.id == uid).first()
-            if not part:
+        values = {}
+        if sorter is not None:
+            values['sorter'] = sorter
+        if name is not None:
+            values['name'] = name
+        if quantity is not None:
+            values['quantity'] = quantity
+        if quantity_type is not None:
+            values['quantity_type'] = quantity_type
+        if enable_quantity is not None:
+            values['enable_quantity'] = enable_quantity
+        if tags is not None:
+            values['tags'] = tags
+        if price is not None:
+            values['price'] = price
+        if notes is not None:
+            values['notes'] = notes
+        if location is not None:
+            values['location'] = location
+        if attributes is not None:
+            values['attrs'] = json.dumps(attributes)
+
+        def operation(session: Session):
+            try:
+                updated = self._update_row(session, Part, uid, values, Part.name, Part.tags)
+            except IntegrityError:
+                raise SorterIdInvalidException(
+                    f"Part with id: {uid} references a sorter or location that does not exist"
+                )
+            if updated is None:
                 raise SorterIdInvalidException(f"Part with id: {uid} does not exist")
-            
-            if sorter is not None:
-                part.sorter = sorter
-            if name is not None:
-                part.name = name
-            if quantity is not None:
-                part.quantity = quantity
-            if quantity_type is not None:
-                part.quantity_type = quantity_type
-            if enable_quantity is not None:
-                part.enable_quantity = enable_quantity
-            if tags is not None:
-                part.tags = tags
-            if price is not None:
-                part.price = price
-            if notes is not None:
-                part.notes = notes
-            if location is not None:
-                part.location = location
-            if attributes is not None:
-                part.attrs = json.dumps(attributes)
-            
+            self._record(session, "part", uid, updated.name, updated.tags)
+
+        self._write(operation)
+        logger.info(f"Updated part with id: {uid}")
+
+    # Quantity history methods
+    def rollup_quantity_history(
+        self,
+        raw_retention_days: float = 7,
+        hour_retention_days: float = 90,
+        day_retention_days: float = 3650,
+    ) -> Dict[str, int]:
+        """Fold new quantity events into hourly and daily buckets, then apply retention
+
+        Only buckets from the latest hourly rollup onwards are recomputed, so a
+        run costs about as much as the events since the previous run. Rollups
+        are upserts, running this from several processes at once is harmless.
+        """
+        now = int(time.time())
+        with self.get_session() as session:
+            since = session.execute(
+                select(func.max(PartQuantityRollup.start)).where(PartQuantityRollup.bucket == 'hour')
+            ).scalar() or 0
+            session.execute(
+                text(_ROLLUP_FROM_EVENTS),
+                {'bucket': 'hour', 'size': HISTORY_BUCKETS['hour'], 'since': since},
+            )
+            session.execute(
+                text(_ROLLUP_FROM_ROLLUPS),
+                {
+                    'bucket': 'day',
+                    'source': 'hour',
+                    'size': HISTORY_BUCKETS['day'],
+                    'since': since - since % HISTORY_BUCKETS['day'],
+                },
+            )
+
+            # Cutoffs are aligned to the next coarser bucket, so a bucket that is
+            # recomputed never misses part of its source rows
+            def cutoff(days: float, size: int) -> int:
+                moment = min(now - int(days * 86400), now)
+                return moment - moment % size
+
+            deleted = {
+                'raw': session.execute(
+                    delete(PartQuantityEvent).where(
+                        PartQuantityEvent.ts < cutoff(raw_retention_days, HISTORY_BUCKETS['hour'])
+                    )
+                ).rowcount,
+            }
+            for bucket, days in (('hour', hour_retention_days), ('day', day_retention_days)):
+                deleted[bucket] = session.execute(
+                    delete(PartQuantityRollup).where(
+                        PartQuantityRollup.bucket == bucket,
+                        PartQuantityRollup.start < cutoff(days, HISTORY_BUCKETS['day']),
+                    )
+                ).rowcount
             session.commit()
-            logger.info(f"Updated part with id: {uid}")
\ No newline at end of file
+
+        logger.debug(f"Rolled up quantity history since {since}, expired {deleted}")
+        return deleted
+
+    def get_quantity_history(
+        self, uid: str, bucket: str = 'day', start: int | None = None, end: int | None = None
+    ) -> List[Dict]:
+        """Get the quantity history of a part, oldest first
+
+        `bucket` is 'raw' for individual events or one of HISTORY_BUCKETS,
+        `start` and `end` are unix timestamps.
+        """
+        # Rollups do not bump the revision, a read replica would not notice them
+        if bucket != 'raw' and bucket not in HISTORY_BUCKETS:
+            raise SorterIdInvalidException(f"Unknown history bucket: {bucket}")
+        with self.get_session() as session:
+            if session.execute(select(Part.id).where(Part.id == uid)).first() is None:
+                raise SorterIdInvalidException(f"Part with id: {uid} does not exist")
+
+            if bucket == 'raw':
+                query = select(PartQuantityEvent).where(PartQuantityEvent.part_id == uid)
+                if start is not None:
+                    query = query.where(PartQuantityEvent.ts >= start)
+                if end is not None:
+                    query = query.where(PartQuantityEvent.ts < end)
+                events = session.scalars(query.order_by(PartQuantityEvent.id)).all()
+                return [
+                    {
+                        'start': e.ts,
+                        'open_quantity': e.quantity - e.delta,
+                        'close_quantity': e.quantity,
+                        'min_quantity': e.quantity,
+                        'max_quantity': e.quantity,
+                        'added': max(e.delta, 0),
+                        'consumed': max(-e.delta, 0),
+                        'events': 1,
+                    }
+                    for e in events
+                ]
+
+            query = select(PartQuantityRollup).where(
+                PartQuantityRollup.part_id == uid, PartQuantityRollup.bucket == bucket
+            )
+            if start is not None:
+                query = query.where(PartQuantityRollup.start >= start - start % HISTORY_BUCKETS[bucket])
+            if end is not None:
+                query = query.where(PartQuantityRollup.start < end)
+            rollups = session.scalars(query.order_by(PartQuantityRollup.start)).all()
+            return [
+                {
+                    'start': r.start,
+                    'open_quantity': r.open_quantity,
+                    'close_quantity': r.close_quantity,
+                    'min_quantity': r.min_quantity,
+                    'max_quantity': r.max_quantity,
+                    'added': r.added,
+                    'consumed': r.consumed,
+                    'events': r.events,
+                }
+                for r in rollups
+            ]
@@ -0,0 +1,197 @@
+import bisect
+import heapq
+import re
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+# Separates the term from the part id in index keys. It sorts before every
+# other character, so an exact term comes before longer terms sharing its prefix
+SEPARATOR = "\x00"
+# How many keys to look at per field for one query, bounds the latency of
+# short prefixes that match a large part of the catalogue
+MAX_SCAN = 1000
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def name_words(name: str) -> List[str]:
+    return WORD_PATTERN.findall(name.lower())
+
+
+def split_tags(tags: str | None) -> List[str]:
+    if not tags:
+        return []
+    return [normalize(tag) for tag in tags.split(",") if tag.strip()]
+
+
+class PrefixIndex:
+    """In-memory prefix index over part names and tags for typeahead
+
+    Each field is a sorted list of "term\\0part id" keys searched with bisect.
+    Full names rank above words inside names, which rank above tags; inside a
+    field exact and closer matches rank higher.
+
+    The index follows PartSorter through add_listener. Changes made by this
+    process are applied incrementally; if the revision shows that someone
+    else committed in between (another worker, a cascade, a bulk import) the
+    index is marked stale. The next search starts a rebuild in a background
+    thread and, like every search until it is done, uses the old contents.
+    """
+
+    FIELDS = (("name", 3.0), ("word", 2.0), ("tag", 1.0))
+
+    def __init__(self):
+        self.revision: Optional[int] = None
+        self._lock = threading.Lock()
+        # Held while building, so only one request or thread does it at a time
+        self._rebuild_lock = threading.Lock()
+        self._built = False
+        self._keys: Dict[str, List[str]] = {field: [] for field, _ in self.FIELDS}
+        self._parts: Dict[str, Tuple[str, str]] = {}
+
+    @staticmethod
+    def _terms(name: str, tags: str | None) -> Dict[str, List[str]]:
+        return {
+            "name": [normalize(name)],
+            "word": sorted(set(name_words(name))),
+            "tag": sorted(set(split_tags(tags))),
+        }
+
+    def rebuild(self, parts: Iterable[Tuple[str, str, str]], revision: int):
+        """Replace the index contents with (id, name, tags) rows read at `revision`"""
+        keys: Dict[str, List[str]] = {field: [] for field, _ in self.FIELDS}
+        entries: Dict[str, Tuple[str, str]] = {}
+        for uid, name, tags in parts:
+            entries[uid] = (name, tags or "")
+            for field, terms in self._terms(name, tags).items():
+                keys[field].extend(f"{term}{SEPARATOR}{uid}" for term in terms)
+        for field_keys in keys.values():
+            field_keys.sort()
+
+        with self._lock:
+            self._keys = keys
+            self._parts = entries
+            self.revision = revision
+            self._built = True
+        logger.debug(f"Built suggestion index over {len(entries)} parts at revision {revision}")
+
+    def ensure_current(self, revision: int, load: Callable[[], Iterable[Tuple[str, str, str]]]):
+        """Bring the index to `revision` using `load` to read all parts
+
+        The first build happens in the caller. Later ones run in a single
+        background thread while searches keep using the stale contents.
+        """
+        if self.revision == revision:
+            return
+        if not self._built:
+            with self._rebuild_lock:
+                # Another request may have built it while this one waited
+                if not self._built:
+                    self.rebuild(load(), revision)
+                    return
+            if self.revision == revision:
+                return
+
+        if not self._rebuild_lock.acquire(blocking=False):
+            return
+        try:
+            threading.Thread(
+                target=self._rebuild_in_background,
+                args=(revision, load),
+                name="suggest-rebuild",
+                daemon=True,
+            ).start()
+        except Exception:
+            self._rebuild_lock.release()
+            raise
+
+    def _rebuild_in_background(self, revision: int, load: Callable[[], Iterable[Tuple[str, str, str]]]):
+        try:
+            if self.revision != revision:
+                self.rebuild(load(), revision)
+        except Exception as e:
+            logger.error(f"Failed to rebuild suggestion index: {repr(e)}")
+        finally:
+            self._rebuild_lock.release()
+
+    def _remove(self, uid: str):
+        entry = self._parts.pop(uid, None)
+        if entry is None:
+            return
+        for field, terms in self._terms(*entry).items():
+            field_keys = self._keys[field]
+            for term in terms:
+                key = f"{term}{SEPARATOR}{uid}"
+                index = bisect.bisect_left(field_keys, key)
+                if index < len(field_keys) and field_keys[index] == key:
+                    del field_keys[index]
+
+    def _add(self, uid: str, name: str, tags: str | None):
+        self._parts[uid] = (name, tags or "")
+        for field, terms in self._terms(name, tags).items():
+            for term in terms:
+                bisect.insort(self._keys[field], f"{term}{SEPARATOR}{uid}")
+
+    def apply(self, changes: List[tuple], revision: int):
+        """PartSorter listener, see PartSorter.add_listener"""
+        with self._lock:
+            # The index may already have been rebuilt at this revision,
+            # applying the changes again is harmless
+            if self.revision is None or revision not in (self.revision, self.revision + 1):
+                self.revision = None
+                return
+
+            for change in changes:
+                kind, uid = change[0], change[1]
+                if kind == "part":
+                    self._remove(uid)
+                    self._add(uid, change[2], change[3])
+                elif kind == "part_deleted":
+                    self._remove(uid)
+                elif kind in ("sorter_deleted", "location_deleted", "parts_bulk"):
+                    # Too many parts may have changed, rebuild instead
+                    self.revision = None
+                    return
+            self.revision = revision
+
+    def search(self, prefix: str, limit: int = 10) -> List[Dict]:
+        prefix = normalize(prefix)
+        if not prefix or limit <= 0:
+            return []
+
+        scores: Dict[str, float] = {}
+        with self._lock:
+            for field, weight in self.FIELDS:
+                field_keys = self._keys[field]
+                start = bisect.bisect_left(field_keys, prefix)
+                for key in field_keys[start:start + MAX_SCAN]:
+                    if not key.startswith(prefix):
+                        break
+                    term_length = key.index(SEPARATOR)
+                    uid = key[term_length + 1:]
+                    # Bonus below 1 so a field never outranks the one above it
+                    score = weight + 0.4 * len(prefix) / term_length
+                    if term_length == len(prefix):
+                        score += 0.5
+                    if score > scores.get(uid, 0.0):
+                        scores[uid] = score
+                # Lower fields can not beat what was found here
+                if len(scores) >= limit:
+                    break
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [
+                {
+                    "id": uid,
+                    "name": self._parts[uid][0],
+                    "tags": self._parts[uid][1],
+                    "score": round(score, 3),
+                }
+                for uid, score in best
+            ]
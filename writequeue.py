@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple, Type
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+Operation = Callable[[Session], Any]
+
+
+class WriteBatcher:
+    """Group commits for write operations from many callers
+
+    Operations are queued and a single writer thread runs them in shared
+    transactions, committing once every `max_batch` operations or `max_delay`
+    seconds, whichever comes first. Every caller gets its own result (or
+    exception) through the future returned by `submit`.
+
+    Operations must not commit or roll back. An operation raising one of
+    `expected_errors` is assumed to have left the database untouched and does
+    not affect the rest of its batch; any other error makes the batch retry
+    each operation in its own transaction.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        max_batch: int = 64,
+        max_delay: float = 0.005,
+        expected_errors: Tuple[Type[Exception], ...] = (),
+    ):
+        self.session_factory = session_factory
+        self.expected_errors = expected_errors
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="write-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, operation: Operation) -> Future:
+        future: Future = Future()
+        self._queue.put((future, operation))
+        return future
+
+    def stop(self):
+        """Commit everything already queued, then stop the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch: List[Tuple[Future, Operation]]):
+        outcomes = []
+        try:
+            with self.session_factory() as session:
+                for future, operation in batch:
+                    try:
+                        outcomes.append((future, operation(session), None))
+                    except self.expected_errors as e:
+                        outcomes.append((future, None, e))
+                session.commit()
+        except Exception as e:
+            logger.warning(
+                f"Batched commit of {len(batch)} writes failed, retrying one by one: {repr(e)}"
+            )
+            for future, operation in batch:
+                self._commit_one(future, operation)
+            return
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _commit_one(self, future: Future, operation: Operation):
+        try:
+            with self.session_factory() as session:
+                result = operation(session)
+                session.commit()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)